@@ -0,0 +1,440 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+asyncio tile fetching backend
+
+one event loop thread downloads the tiles of any number of tile sources,
+cache reads and writes run in a small thread pool:
+
+    fetcher = AsyncTileFetcher()
+    tilesource = OSMTileSource("osm", cachedir, fetcher=fetcher)
+
+callbacks of background requests are executed in the event loop thread,
+pyqtSignal.emit can be passed to deliver them to the Qt event loop (see qtWmsMap)
+'''
+
+import asyncio
+import heapq
+import time
+import logging
+from email.parser import Parser
+from functools import partial
+from itertools import count
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.client import HTTPMessage, HTTPException
+from urllib.parse import urlsplit
+
+from qtmaps.httppool import HTTPResponse, DEFAULT_HEADERS
+from qtmaps.wms import TileSource, TileRequest, InflightTile, PRIORITY_VIEW, PRIORITY_RESERVE
+
+log = logging.getLogger(__name__)
+
+
+# errors of a reused connection the server has already closed
+STALE_CONNECTION_ERRORS = (ConnectionError, asyncio.IncompleteReadError, HTTPException)
+
+class AsyncHTTPClient():
+    """ minimal HTTP/1.1 GET client with keep-alive,
+        keeps up to pool_size idle connections per (scheme, host, port)
+        may only be used in one event loop
+    """
+
+    def __init__(self, pool_size=8, timeout=10, headers=None):
+        self.poolSize = pool_size
+        self.timeout = timeout
+        self.headers = dict(DEFAULT_HEADERS, **(headers or {}))
+        self.idle = dict()
+        self.stats = dict(requests=0, connections=0, reused=0, errors=0)
+
+    async def _getConnection(self, key):
+        """ returns (reader, writer, reused) """
+        connections = self.idle.get(key)
+        while connections:
+            (reader, writer) = connections.pop()
+            if not(reader.at_eof() or writer.is_closing()):
+                return (reader, writer, True)
+            writer.close()
+        (scheme, host, port) = key
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=(scheme == "https")),
+                                                  self.timeout)
+        self.stats["connections"] += 1
+        return (reader, writer, False)
+
+    def _putConnection(self, key, reader, writer):
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.poolSize:
+            connections.append((reader, writer))
+        else:
+            writer.close()
+
+    async def get(self, url, headers=None) -> HTTPResponse:
+        """ GET request, raises OSError, asyncio.TimeoutError or HTTPException on connection errors """
+        parts = urlsplit(url)
+        https = parts.scheme == "https"
+        key = (parts.scheme, parts.hostname, parts.port or (443 if https else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        host = parts.hostname + (":%d" % parts.port if parts.port else "")
+        request_headers = dict(self.headers, **(headers or {}))
+        lines = ["GET %s HTTP/1.1" % path, "Host: %s" % host]
+        lines.extend(["%s: %s" % item for item in request_headers.items()])
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        self.stats["requests"] += 1
+        while True:
+            (reader, writer, reused) = await self._getConnection(key)
+            try:
+                writer.write(request)
+                (status, headers, data, keep_alive) = await asyncio.wait_for(self._readResponse(reader), self.timeout)
+            except STALE_CONNECTION_ERRORS:
+                writer.close()
+                if reused:
+                    # server closed the idle connection, retry with a new one
+                    continue
+                self.stats["errors"] += 1
+                raise
+            except (OSError, asyncio.TimeoutError):
+                writer.close()
+                self.stats["errors"] += 1
+                raise
+            if reused:
+                self.stats["reused"] += 1
+            if keep_alive:
+                self._putConnection(key, reader, writer)
+            else:
+                writer.close()
+            return HTTPResponse(status, headers, data)
+
+    async def _readResponse(self, reader):
+        """ returns (status, headers, data, keep_alive) """
+        head = await reader.readuntil(b"\r\n\r\n")
+        (statusline, _, headertext) = head.decode("latin-1").partition("\r\n")
+        parts = statusline.split(" ", 2)
+        if len(parts) < 2 or not(parts[0].startswith("HTTP/")) or not(parts[1].isdigit()):
+            raise HTTPException("bad status line %r" % statusline)
+        (version, status) = (parts[0], int(parts[1]))
+        headers = Parser(_class=HTTPMessage).parsestr(headertext)
+        keep_alive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        if status in (204, 304) or status < 200:
+            data = b""
+        elif "chunked" in headers.get("Transfer-Encoding", "").lower():
+            data = await self._readChunked(reader)
+        elif not(headers.get("Content-Length") is None):
+            data = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            # body ends with the connection
+            data = await reader.read()
+            keep_alive = False
+        return (status, headers, data, keep_alive)
+
+    @staticmethod
+    async def _readChunked(reader) -> bytes:
+        chunks = []
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            size = int(line.split(b";")[0], 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def getStats(self) -> dict:
+        """ same counters as HTTPConnectionPool.getStats() """
+        stats = dict(self.stats)
+        stats["idle"] = sum([len(x) for x in self.idle.values()])
+        stats["reuse_ratio"] = stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+    def close(self):
+        idle, self.idle = self.idle, dict()
+        for connections in idle.values():
+            for (reader, writer) in connections:
+                writer.close()
+
+
+class AsyncHostLimiter():
+    """ event loop version of wms.HostLimiter, a token bucket of burst requests refilled at rate per second
+        and a limit of concurrent requests, only used in the event loop thread
+    """
+
+    def __init__(self, rate=None, max_inflight=2, burst=4):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.maxInflight = max_inflight
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.inflight = 0
+
+    def tryAcquire(self, reserve=0):
+        """ see wms.HostLimiter.tryAcquire() """
+        if self.inflight >= self.maxInflight - min(reserve, self.maxInflight - 1):
+            return None
+        if self.rate:
+            current_time = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (current_time - self.updated) * self.rate)
+            self.updated = current_time
+            needed = 1 + min(reserve, self.burst - 1)
+            if self.tokens < needed:
+                return (needed - self.tokens) / self.rate
+            self.tokens -= 1
+        self.inflight += 1
+        return 0
+
+    def release(self):
+        self.inflight -= 1
+
+
+class AsyncTileFetcher():
+    """ downloads tiles in one asyncio event loop thread, shared by any number of tile sources
+        up to max_tasks downloads run concurrently, jobs wait in one queue per host 
+        until its AsyncHostLimiter admits them and run in order of priority like in wms.TileDownloader,
+        concurrent requests for the same tile wait for one download,
+        the cache is accessed in a pool of io_workers threads
+    """
+
+    def __init__(self, max_tasks=1024, io_workers=4, client:AsyncHTTPClient=None):
+        self.maxTasks = max_tasks
+        self.executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="tileio")
+        self.client = client or AsyncHTTPClient()
+        self.loop = None
+        self.thread = None
+        self.counter = count()
+        self.limiters = dict()
+        self.inflight = dict()
+        self.lock = Lock()
+        # only used in the event loop thread
+        self.ready = dict()         # AsyncHostLimiter -> heap of (priority, n, key, entry, job)
+        self.tasks = set()
+        self.timer = None           # dispatch when the next token of a waiting host is available
+
+    def start(self):
+        """ starts the event loop thread, called on first use """
+        with self.lock:
+            if self.loop:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = Thread(target=self.loop.run_forever, name="tilefetch")
+            self.thread.daemon = True
+            self.thread.start()
+
+    async def _stop(self):
+        if self.timer:
+            self.timer.cancel()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.client.close()
+
+    def _put(self, tilesource:TileSource, url, item):
+        heapq.heappush(self.ready.setdefault(self.getLimiter(tilesource, url), []), item)
+        self._dispatch()
+
+    def _dispatch(self):
+        """ starts the first jobs of the hosts admitting another request, jobs whose
+            requests have all been cancelled are dropped without a download
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        delay = None
+        while len(self.tasks) < self.maxTasks:
+            started = False
+            for limiter in sorted(self.ready, key=lambda limiter: self.ready[limiter][0][:2]):
+                queue = self.ready[limiter]
+                (priority, n, key, entry, job) = queue[0]
+                with self.lock:
+                    skipped = entry.started or entry.isCancelled()
+                    if skipped and not(entry.started):
+                        entry.started = True
+                        self.inflight.pop(key, None)
+                        entry.future.set_result(None)
+                if not(skipped):
+                    wait = limiter.tryAcquire(reserve=PRIORITY_RESERVE.get(priority, 0))
+                    if wait is None:
+                        continue
+                    if wait > 0:
+                        delay = wait if delay is None else min(delay, wait)
+                        continue
+                heapq.heappop(queue)
+                if not(queue):
+                    self.ready.pop(limiter)
+                if not(skipped):
+                    with self.lock:
+                        entry.started = True
+                    task = asyncio.ensure_future(self._run(key, entry, job, limiter))
+                    self.tasks.add(task)
+                started = True
+                break
+            if not(started):
+                break
+        if not(delay is None) and len(self.tasks) < self.maxTasks:
+            self.timer = self.loop.call_later(delay, self._dispatch)
+
+    async def _run(self, key, entry:InflightTile, job, limiter:AsyncHostLimiter):
+        try:
+            result = await job()
+        except Exception as e:
+            entry.future.set_exception(e)
+        else:
+            entry.future.set_result(result)
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            limiter.release()
+            self.tasks.discard(asyncio.current_task())
+            self._dispatch()
+
+    def runBlocking(self, func, *args):
+        """ runs func(*args) in the io threads, returns an awaitable """
+        return self.loop.run_in_executor(self.executor, partial(func, *args))
+
+    def getLimiter(self, tilesource:TileSource, url) -> AsyncHostLimiter:
+        """ returns the limiter of the host of url, created with the limits of tilesource on first use """
+        host = urlsplit(url).hostname
+        if not(host in self.limiters):
+            rate = 1/tilesource.download_delay if tilesource.download_delay else None
+            self.limiters[host] = AsyncHostLimiter(rate=rate, max_inflight=tilesource.maxInflight,
+                                                   burst=tilesource.downloadBurst)
+        return self.limiters[host]
+
+    def submitTile(self, tilesource:TileSource, tilex, tiley, zoom, request:TileRequest=None,
+                   priority=PRIORITY_VIEW, revalidate=False) -> Future:
+        """ returns a concurrent.futures.Future of the tile location (None on errors),
+            same semantics as TileDownloader.submitTile(), thread-safe
+        """
+        self.start()
+        key = (tilesource.getLayerName(), zoom, tilex, tiley, revalidate)
+        with self.lock:
+            entry = self.inflight.get(key)
+            if entry is None:
+                entry = InflightTile(request, priority)
+                self.inflight[key] = entry
+            else:
+                entry.requests.append(request)
+                if entry.started or priority >= entry.priority:
+                    return entry.future
+                entry.priority = priority
+        job = partial(self.downloadTile, tilesource, tilex, tiley, zoom, revalidate)
+        item = (priority, next(self.counter), key, entry, job)
+        url = tilesource.getTileUrl(tilex, tiley, zoom)
+        self.loop.call_soon_threadsafe(self._put, tilesource, url, item)
+        return entry.future
+
+    async def downloadTile(self, tilesource:TileSource, tilex, tiley, zoom, revalidate=False):
+        """ returns the location of the tile in the cache or None, runs holding a slot of the host """
+        if type(tilesource).downloadTile != TileSource.downloadTile:
+            # source with its own blocking download
+            func = tilesource.revalidateTile if revalidate else tilesource.downloadTile
+            return await self.runBlocking(func, tilex, tiley, zoom)
+        meta = None
+        if revalidate:
+            meta = await self.runBlocking(tilesource.cache.readMeta, tilesource.getLayerName(), tilex, tiley, zoom)
+        url = tilesource.getTileUrl(tilex, tiley, zoom)
+        if type(tilesource).fetchTileData != TileSource.fetchTileData:
+            # source with its own blocking fetch, e.g. synthetic tiles
+            (data, meta) = await self.runBlocking(tilesource.fetchTileData, tilex, tiley, zoom, meta)
+            return await self.runBlocking(tilesource.storeTile, tilex, tiley, zoom, data, meta)
+        try:
+            log.debug("GET %s", url)
+            start = time.perf_counter()
+            response = await self.client.get(url, headers=tilesource.getRequestHeaders(meta))
+        except (OSError, HTTPException, asyncio.TimeoutError) as e:
+            log.warning("download of %s failed: %r", url, e)
+            tilesource.metrics.count("download_errors")
+            return None
+        tilesource.recordResponse(response, time.perf_counter() - start)
+        (data, meta) = tilesource.parseResponse(url, response, meta)
+        if data is None:
+            return None
+        return await self.runBlocking(tilesource.storeTile, tilex, tiley, zoom, data, meta)
+
+    def submitRequest(self, tilesource:TileSource, request:TileRequest, tiles, tileSetID, callback, tileCallback=None):
+        """ asyncio version of TileSource._requestTilesRun(), does not block """
+        self.start()
+        coro = self._provideTiles(tilesource, request, tiles, tileSetID, callback, tileCallback)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _provideTiles(self, tilesource:TileSource, request:TileRequest, tiles, tileSetID, callback, tileCallback):
+        """ see TileSource.provideTiles() """
+        requestID = request.requestID
+        try:
+            layer = tilesource.getLayerName()
+            keys = [(tile.xtile, tile.ytile, tile.zoom) for tile in tiles]
+            cached = await self.runBlocking(tilesource.cache.lookup, layer, keys)
+            tilesource.recordLookup(len(cached), len(keys))
+            if tilesource.MAX_AGE and cached:
+                for key in await self.runBlocking(tilesource.cache.stale, layer, cached, tilesource.MAX_AGE):
+                    tilesource.submitRevalidation(*key)
+            futures = dict()
+            for tile in tiles:
+                if (tile.xtile, tile.ytile, tile.zoom) in cached:
+                    tile.path = tilesource.cache.location(layer, tile.xtile, tile.ytile, tile.zoom)
+                    if tileCallback:
+                        tileCallback(requestID, tileSetID, tile)
+                else:
+                    future = tilesource.submitDownload(tile.xtile, tile.ytile, tile.zoom, request)
+                    futures[asyncio.wrap_future(future)] = tile
+            pending = set(futures)
+            while pending and not(request.cancelled):
+                (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if request.cancelled:
+                        break
+                    tile = futures[future]
+                    tile.path = None if future.exception() else future.result()
+                    if tileCallback:
+                        tileCallback(requestID, tileSetID, tile)
+        finally:
+            tilesource.requests.pop(requestID, None)
+            callback(requestID, tileSetID)
+
+    def getStats(self) -> dict:
+        """ HTTP counters, queued and in-flight tiles """
+        stats = self.client.getStats()
+        with self.lock:
+            stats["inflight"] = len(self.inflight)
+        return stats
+
+    def close(self):
+        """ stops the event loop thread """
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+        self.executor.shutdown(wait=False)
+
+
+_defaultFetcher = None
+
+def getDefaultFetcher() -> AsyncTileFetcher:
+    global _defaultFetcher
+    if _defaultFetcher is None:
+        _defaultFetcher = AsyncTileFetcher()
+    return _defaultFetcher
+
+
+# test
+
+def test():
+    import tempfile
+    from qtmaps.wms import OSMTileSource
+    fetcher = AsyncTileFetcher()
+    tilesource = OSMTileSource("osm", tempfile.mkdtemp(), fetcher=fetcher)
+    futures = [tilesource.submitDownload(x, y, 2) for x in range(4) for y in range(4)]
+    print([f.result() for f in futures])
+    print(fetcher.getStats())
+    fetcher.close()
+
+if __name__ == "__main__":
+    test()
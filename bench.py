@@ -0,0 +1,325 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+headless benchmarks of the map pipeline against a local tile server
+
+python -m qtmaps.bench --out results.json
+python -m qtmaps.bench --out new.json --compare results.json
+
+runs under Qt's offscreen platform, every case is run with a cold cache
+(empty tile directory and pixmap cache, redrawMap: empty pixmap cache only) and again 
+with the caches warm, reports wall time, GUI thread time, python allocations and tiles/s
+of the tiles drawn by the case
+'''
+
+import argparse
+import http.server
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QEventLoop, QT_VERSION_STR
+from PyQt5.Qt import QApplication, QGraphicsScene
+
+from qtmaps.wms import TileSource
+from qtmaps.qt import qtWMSView, qtWmsMap, qtTileCache, getTileCache
+from qtmaps.synthetic import encodePNG, renderTile
+
+
+LOCATION = (11.6, 52.1)
+SIZES = ((640, 480), (1280, 800), (1920, 1080))
+ZOOMS = (4, 12, 17)
+TIMEOUT = 30
+
+
+class TileServer():
+    """ local tile server answering /{z}/{x}/{y}.png after latency seconds """
+
+    def __init__(self, latency=0.02, variants=8):
+        self.latency = latency
+        self.tiles = [encodePNG(renderTile(i, 0, 0, 0)) for i in range(variants)]
+        self.requests = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                data = server.tiles[hash(self.path) % len(server.tiles)]
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def getUrl(self):
+        return "http://127.0.0.1:%d/{z}/{x}/{y}.png" % self.port
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class BenchTileSource(TileSource):
+    SRC_NAME = "bench"
+    MAX_AGE = None
+
+    def __init__(self, name, cachedir, url, **kwargs):
+        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=0, max_inflight=16, **kwargs)
+        self.TILE_URL = url
+
+
+class Benchmark():
+    """ runs the cases, results are dicts with the case parameters and the measurements """
+
+    def __init__(self, app, server:TileServer, alloc=True):
+        self.app = app
+        self.server = server
+        self.alloc = alloc
+        self.tmpdir = tempfile.mkdtemp(prefix="qtmaps-bench-")
+        self.results = []
+        self.closed = []
+
+    def createTileSource(self, name):
+        cachedir = os.path.join(self.tmpdir, name)
+        shutil.rmtree(cachedir, ignore_errors=True)
+        return BenchTileSource(name, cachedir, self.server.getUrl())
+
+    def processEvents(self):
+        """ returns the time spent handling events """
+        start = time.perf_counter()
+        self.app.processEvents(QEventLoop.AllEvents, 20)
+        return time.perf_counter() - start
+
+    def waitFor(self, done, timeout=TIMEOUT):
+        """ runs the event loop until done() is true, returns (gui seconds, timed out) """
+        gui = 0.0
+        end = time.perf_counter() + timeout
+        while not(done()):
+            if time.perf_counter() > end:
+                return (gui, True)
+            gui += self.processEvents()
+            time.sleep(0.001)
+        return (gui, False)
+
+    def measure(self, name, params, action, done=None, tiles=0):
+        """ action() runs on the GUI thread, then the event loop runs until done() """
+        requests = self.server.requests
+        if self.alloc:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            (before, _) = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        ret = action()
+        gui = time.perf_counter() - start
+        timeout = False
+        if done:
+            (waited, timeout) = self.waitFor(done)
+            gui += waited
+        wall = time.perf_counter() - start
+        result = dict(name=name, wall_ms=wall*1000, gui_ms=gui*1000, timeout=timeout,
+                      http_requests=self.server.requests - requests)
+        result.update(params)
+        if self.alloc:
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result.update(alloc_peak_kb=(peak - before)/1024, alloc_net_kb=(current - before)/1024)
+        ntiles = tiles() if callable(tiles) else (tiles or (ret if isinstance(ret, int) else 0))
+        result.update(tiles=ntiles, tiles_per_s=ntiles/wall if wall else 0.0)
+        self.results.append(result)
+        print("%-20s %-40s %9.1f ms wall %9.1f ms gui %6d tiles" % (name, params, result["wall_ms"], result["gui_ms"], ntiles),
+              file=sys.stderr)
+        return result
+
+    @staticmethod
+    def tileCount(tileset):
+        return sum([len(row) for row in tileset.tiles])
+
+    @staticmethod
+    def placedCounter(view:qtWMSView):
+        """ returns a function counting the tiles placed in view from now on """
+        count = lambda: view.metrics.snapshot()["histograms"].get("place_ms", dict(count=0))["count"]
+        start = count()
+        return lambda: count() - start
+
+    @staticmethod
+    def clearView(view:qtWMSView):
+        """ drops the decoded tiles and the tile layer of view, the tiles stay in the disk cache """
+        view.tileCache.clear()
+        view.tileLayer.removeTiles(list(view.tileLayer.tiles) + list(view.tileLayer.placeholders))
+
+    def viewComplete(self, view:qtWMSView):
+        tileSet = view.tilesource.getActiveTileSet()
+        return all([(t.zoom, t.xtile, t.ytile) in view.tileLayer.tiles for row in tileSet.tiles for t in row])
+
+    def createView(self, tilesource, size, tilecache):
+        view = qtWMSView(tilesource, initial=LOCATION+(0,), tilecache=tilecache, prefetch=False)
+        view.setScene(QGraphicsScene())
+        view.resize(*size)
+        view.show()
+        self.processEvents()
+        return view
+
+    def closeView(self, view, tilesource):
+        """ cancels the pending requests and waits for their threads, which emit signals of the view,
+            the view is kept alive for decodings still running
+        """
+        tilesource.cancelRequests()
+        self.waitFor(lambda: not(tilesource.requests))
+        view.close()
+        self.closed.append(view)
+
+    # cases
+
+    def benchLoadTiles(self, size, zoom):
+        """ synchronous TileSource._loadTiles """
+        tilesource = self.createTileSource("load-%dx%d-%d" % (size + (zoom,)))
+        (w, h) = size
+        args = (LOCATION[0], LOCATION[1], zoom, w/2, w/2, h/2, h/2)
+        for cache in ("cold", "warm"):
+            action = lambda: self.tileCount(tilesource._loadTiles(*args))
+            self.measure("loadTiles", dict(width=w, height=h, zoom=zoom, cache=cache), action)
+
+    def benchChangeView(self, size, zoom):
+        """ qtWMSView.changeView until all tiles are placed, then redrawMap and panXY of the loaded view """
+        tilesource = self.createTileSource("view-%dx%d-%d" % (size + (zoom,)))
+        view = self.createView(tilesource, size, qtTileCache())
+        (w, h) = size
+        for cache in ("cold", "warm"):
+            params = dict(width=w, height=h, zoom=zoom, cache=cache)
+            # leave the view, so changeView draws the tile set from scratch
+            view.changeView(LOCATION[0], LOCATION[1], max(zoom-3, 0))
+            self.waitFor(lambda: self.viewComplete(view))
+            if cache == "cold":
+                self.clearView(view)
+            action = lambda: view.changeView(LOCATION[0], LOCATION[1], zoom)
+            tiles = lambda: self.tileCount(tilesource.getActiveTileSet())
+            self.measure("changeView", params, action, done=lambda: self.viewComplete(view), tiles=tiles)
+            if cache == "cold":
+                # the tiles are decoded again from the disk cache
+                self.clearView(view)
+            self.measure("redrawMap", params, view.redrawMap, done=lambda: self.viewComplete(view), tiles=tiles)
+        # pan 10 viewport widths to the east, tiles are streamed in
+        params = dict(width=w, height=h, zoom=zoom, cache="cold")
+        def pan():
+            for i in range(50):
+                view.panXY(w/5, 0)
+                self.processEvents()
+        def covered():
+            (x1, y1, x2, y2) = view.visibleTileRange()
+            n = 2**zoom
+            return all([(zoom, x, y) in view.tileLayer.tiles for x in range(max(x1, 0), min(x2, n-1)+1)
+                        for y in range(max(y1, 0), min(y2, n-1)+1)])
+        self.measure("panXY", params, pan, done=covered, tiles=self.placedCounter(view))
+        self.closeView(view, tilesource)
+
+    def benchViewRequests(self, size, zoom, steps=5):
+        """ qtWmsMap.centerNext queue of steps views until it is drained """
+        tilesource = self.createTileSource("queue-%dx%d-%d" % (size + (zoom,)))
+        getTileCache().clear()
+        wmsMap = qtWmsMap("bench", tilesource, initial=LOCATION+(zoom,))
+        wmsMap.view.prefetcher = None
+        wmsMap.resize(*size)
+        wmsMap.show()
+        self.waitFor(lambda: self.viewComplete(wmsMap.view))
+        (w, h) = size
+        # one viewport width further east per step
+        coords = [((LOCATION[0] + i * 360 / 2**zoom * w / 256 + 180) % 360 - 180, LOCATION[1]) for i in range(steps)]
+        # the tiles drawn by a run
+        tiles = sum([self.tileCount(tilesource.planTiles(lon, lat, zoom, w/2, w/2, h/2, h/2)) for (lon, lat) in coords])
+        for cache in ("cold", "warm"):
+            def action():
+                for coord in coords:
+                    wmsMap.centerNext(coord, zoom, wait=0)
+            if cache == "cold":
+                self.clearView(wmsMap.view)
+            params = dict(width=w, height=h, zoom=zoom, cache=cache, steps=steps)
+            self.measure("controlViewRequests", params, action, done=lambda: not(wmsMap.viewRequests), tiles=tiles)
+        self.closeView(wmsMap, tilesource)
+
+    def run(self, sizes=SIZES, zooms=ZOOMS):
+        for size in sizes:
+            for zoom in zooms:
+                self.benchLoadTiles(size, zoom)
+                self.benchChangeView(size, zoom)
+                self.benchViewRequests(size, zoom)
+        return self.results
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+CASE_KEYS = ("name", "width", "height", "zoom", "cache", "steps")
+
+def caseKey(result):
+    return tuple([(k, result[k]) for k in CASE_KEYS if k in result])
+
+def compare(results, baseline):
+    """ prints the wall and GUI time of every case relative to the baseline run """
+    base = dict([(caseKey(r), r) for r in baseline["results"]])
+    print("%-60s %12s %12s" % ("case", "wall", "gui"))
+    for result in results["results"]:
+        old = base.get(caseKey(result))
+        if old is None:
+            continue
+        ratio = lambda key: result[key] / old[key] if old[key] else float("nan")
+        case = "%s %dx%d z%d %s" % tuple([result[k] for k in CASE_KEYS[:5]])
+        print("%-60s %11.2fx %11.2fx" % (case, ratio("wall_ms"), ratio("gui_ms")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="headless benchmarks of the map pipeline")
+    parser.add_argument("--out", default=None, help="JSON file of the results")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run")
+    parser.add_argument("--latency", type=float, default=20, help="tile server latency (ms), default: 20")
+    parser.add_argument("--sizes", nargs="+", default=None, help="viewport sizes WxH, default: 640x480 1280x800 1920x1080")
+    parser.add_argument("--zooms", nargs="+", type=int, default=ZOOMS)
+    parser.add_argument("--no-alloc", action="store_true", help="don't trace allocations (lower overhead)")
+    args = parser.parse_args(argv)
+    sizes = [tuple([int(x) for x in s.split("x")]) for s in args.sizes] if args.sizes else SIZES
+    app = QApplication.instance() or QApplication([])
+    server = TileServer(latency=args.latency/1000)
+    bench = Benchmark(app, server, alloc=not(args.no_alloc))
+    try:
+        bench.run(sizes=sizes, zooms=args.zooms)
+    finally:
+        bench.close()
+        server.stop()
+    results = dict(meta=dict(time=time.time(), python=platform.python_version(), qt=QT_VERSION_STR,
+                             platform=platform.platform(), latency_ms=args.latency, alloc=not(args.no_alloc)),
+                   results=bench.results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
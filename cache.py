@@ -0,0 +1,517 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+tile caches
+
+tiles are identified by layer name and (xtile, ytile, zoom) in the OSM scheme
+DirectoryTileCache: one png file per tile, cachedir/layer/zoom/xtile/ytile.png
+MBTilesCache: one sqlite file per layer, cachedir/layer.mbtiles (https://github.com/mapbox/mbtiles-spec)
+
+both keep the metadata of their tiles (fetch time, validators, last access, size)
+in cachedir/tileindex.sqlite, used for revalidation and size-capped eviction
+'''
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from collections import namedtuple
+from threading import Lock, local, get_ident
+
+
+# fetched: time of the download or the last successful revalidation
+TileMeta = namedtuple("TileMeta", ["fetched", "etag", "lastModified"])
+
+
+class SQLiteConnections():
+    """ one connection per thread to the database at path """
+
+    def __init__(self, path, schema=()):
+        self.path = path
+        self.schema = schema
+        self.local = local()
+        self.connections = []
+        self.lock = Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                for statement in self.schema:
+                    conn.execute(statement)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                # connection of another thread
+                pass
+        self.local = local()
+
+
+class TileIndex():
+    """ metadata of cached tiles
+        accesses are buffered in memory and written by flush()
+    """
+
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS tiles (layer TEXT, zoom INTEGER, x INTEGER, y INTEGER, "
+              "fetched REAL, etag TEXT, last_modified TEXT, accessed REAL, size INTEGER, "
+              "PRIMARY KEY (layer, zoom, x, y))",
+              "CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)"]
+
+    def __init__(self, path, flush_size=256):
+        self.db = SQLiteConnections(path, self.SCHEMA)
+        self.flushSize = flush_size
+        self.accesses = dict()
+        self.lock = Lock()
+
+    def put(self, layer, tilex, tiley, zoom, meta:TileMeta, size):
+        conn = self.db.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (layer, zoom, tilex, tiley, meta.fetched, meta.etag, meta.lastModified,
+                          time.time(), size))
+
+    def putMeta(self, layer, tilex, tiley, zoom, meta:TileMeta):
+        conn = self.db.connect()
+        with conn:
+            conn.execute("UPDATE tiles SET fetched=?, etag=?, last_modified=? WHERE layer=? AND zoom=? AND x=? AND y=?",
+                         (meta.fetched, meta.etag, meta.lastModified, layer, zoom, tilex, tiley))
+
+    def get(self, layer, tilex, tiley, zoom) -> TileMeta:
+        cursor = self.db.connect().execute(
+            "SELECT fetched, etag, last_modified FROM tiles WHERE layer=? AND zoom=? AND x=? AND y=?",
+            (layer, zoom, tilex, tiley))
+        row = cursor.fetchone()
+        return None if row is None else TileMeta(*row)
+
+    def stale(self, layer, keys, max_age) -> set:
+        """ returns the subset of keys fetched more than max_age seconds ago
+            tiles without metadata are not stale, they are indexed on their first access
+        """
+        zooms = dict()
+        for key in keys:
+            zooms.setdefault(key[2], set()).add(key)
+        conn = self.db.connect()
+        found = set()
+        for zoom, zkeys in zooms.items():
+            xs = [key[0] for key in zkeys]
+            ys = [key[1] for key in zkeys]
+            cursor = conn.execute(
+                "SELECT x, y FROM tiles WHERE layer=? AND zoom=? AND x BETWEEN ? AND ? "
+                "AND y BETWEEN ? AND ? AND fetched < ?",
+                (layer, zoom, min(xs), max(xs), min(ys), max(ys), time.time()-max_age))
+            for (tilex, tiley) in cursor:
+                if (tilex, tiley, zoom) in zkeys:
+                    found.add((tilex, tiley, zoom))
+        return found
+
+    def touch(self, layer, keys) -> bool:
+        """ records an access of keys, returns True if flush() should be called """
+        current_time = time.time()
+        with self.lock:
+            for (tilex, tiley, zoom) in keys:
+                self.accesses[(layer, zoom, tilex, tiley)] = current_time
+            return len(self.accesses) >= self.flushSize
+
+    def flush(self, sizeof):
+        """ writes the buffered accesses, tiles cached before the index existed are added
+            with sizeof(layer, tilex, tiley, zoom)
+        """
+        with self.lock:
+            accesses, self.accesses = self.accesses, dict()
+        if not(accesses):
+            return
+        conn = self.db.connect()
+        with conn:
+            for (layer, zoom, tilex, tiley), accessed in accesses.items():
+                cursor = conn.execute("UPDATE tiles SET accessed=? WHERE layer=? AND zoom=? AND x=? AND y=?",
+                                      (accessed, layer, zoom, tilex, tiley))
+                if cursor.rowcount == 0:
+                    size = sizeof(layer, tilex, tiley, zoom)
+                    if not(size is None):
+                        conn.execute("INSERT INTO tiles VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?)",
+                                     (layer, zoom, tilex, tiley, accessed, accessed, size))
+
+    def totalSize(self) -> int:
+        return self.db.connect().execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    def oldest(self, n) -> list:
+        """ returns [(layer, tilex, tiley, zoom, size), ...] of the n least recently used tiles """
+        cursor = self.db.connect().execute(
+            "SELECT layer, x, y, zoom, size FROM tiles ORDER BY accessed LIMIT ?", (n,))
+        return cursor.fetchall()
+
+    def deleteMany(self, keys):
+        """ keys: [(layer, tilex, tiley, zoom), ...] """
+        conn = self.db.connect()
+        with conn:
+            conn.executemany("DELETE FROM tiles WHERE layer=? AND x=? AND y=? AND zoom=?", keys)
+
+    def close(self):
+        self.db.close()
+
+
+class TileCache():
+    """ base class of tile caches, all methods are thread-safe
+        subclasses implement location, has, _read, _write, _delete, _sizeof and iterTiles
+        max_bytes: size cap of all tiles, the least recently used tiles are evicted
+    """
+
+    INDEX_FN = "tileindex.sqlite"
+    EVICT_INTERVAL = 64     # writes between two size checks
+    EVICT_TARGET = 0.9      # evict down to this fraction of max_bytes
+
+    def __init__(self, cachedir, max_bytes=None):
+        self.cachedir = cachedir
+        self.maxBytes = max_bytes
+        self.index = TileIndex(os.path.join(cachedir, self.INDEX_FN))
+        self.writes = 0
+        self.evictedCount = 0
+        self.lock = Lock()
+        self.evictLock = Lock()
+
+    def location(self, layer, tilex, tiley, zoom) -> str:
+        """ returns a string identifying the cached tile (file path for directory caches) """
+        raise NotImplementedError
+
+    def has(self, layer, tilex, tiley, zoom) -> bool:
+        raise NotImplementedError
+
+    def lookup(self, layer, keys) -> set:
+        """ returns the subset of keys [(tilex, tiley, zoom), ...] that is cached """
+        found = set([key for key in keys if self.has(layer, *key)])
+        self.touch(layer, found)
+        return found
+
+    def touch(self, layer, keys):
+        """ records an access of the tiles for LRU eviction """
+        if self.index.touch(layer, keys):
+            self.index.flush(self._sizeof)
+
+    def read(self, layer, tilex, tiley, zoom) -> bytes:
+        """ returns the encoded tile or None """
+        data = self._read(layer, tilex, tiley, zoom)
+        if not(data is None):
+            self.touch(layer, [(tilex, tiley, zoom)])
+        return data
+
+    def write(self, layer, tilex, tiley, zoom, data:bytes, meta:TileMeta=None):
+        self._write(layer, tilex, tiley, zoom, data)
+        meta = meta or TileMeta(time.time(), None, None)
+        self.index.put(layer, tilex, tiley, zoom, meta, len(data))
+        with self.lock:
+            self.writes += 1
+            check = self.maxBytes and (self.writes % self.EVICT_INTERVAL == 0)
+        if check:
+            self.enforceLimit()
+
+    def readMeta(self, layer, tilex, tiley, zoom) -> TileMeta:
+        return self.index.get(layer, tilex, tiley, zoom)
+
+    def writeMeta(self, layer, tilex, tiley, zoom, meta:TileMeta):
+        """ updates the metadata of a cached tile, e.g. after a successful revalidation """
+        self.index.putMeta(layer, tilex, tiley, zoom, meta)
+
+    def stale(self, layer, keys, max_age) -> set:
+        """ returns the subset of cached keys fetched more than max_age seconds ago """
+        return self.index.stale(layer, keys, max_age)
+
+    def size(self) -> int:
+        """ size of all indexed tiles in bytes """
+        self.index.flush(self._sizeof)
+        return self.index.totalSize()
+
+    def enforceLimit(self):
+        """ evicts least recently used tiles until the cache is below max_bytes """
+        if not(self.maxBytes) or not(self.evictLock.acquire(blocking=False)):
+            return
+        try:
+            total = self.size()
+            if total <= self.maxBytes:
+                return
+            target = self.maxBytes * self.EVICT_TARGET
+            while total > target:
+                rows = self.index.oldest(256)
+                if not(rows):
+                    break
+                keys = []
+                for (layer, tilex, tiley, zoom, size) in rows:
+                    self._delete(layer, tilex, tiley, zoom)
+                    keys.append((layer, tilex, tiley, zoom))
+                    total -= size or 0
+                    if total <= target:
+                        break
+                self.index.deleteMany(keys)
+                self.evictedCount += len(keys)
+        finally:
+            self.evictLock.release()
+
+    def iterTiles(self, layer):
+        """ yields (tilex, tiley, zoom) of all cached tiles of layer """
+        raise NotImplementedError
+
+    def _read(self, layer, tilex, tiley, zoom) -> bytes:
+        raise NotImplementedError
+
+    def _write(self, layer, tilex, tiley, zoom, data:bytes):
+        raise NotImplementedError
+
+    def _delete(self, layer, tilex, tiley, zoom):
+        raise NotImplementedError
+
+    def _sizeof(self, layer, tilex, tiley, zoom) -> int:
+        """ size of a cached tile or None if it is not cached """
+        raise NotImplementedError
+
+    def close(self):
+        self.index.flush(self._sizeof)
+        self.index.close()
+
+
+class DirectoryTileCache(TileCache):
+
+    def getTilePath(self, layer, tilex, tiley, zoom):
+        tile_dir = os.path.join(self.cachedir, layer, str(zoom), str(tilex))
+        tile_fn = str(tiley)+".png"
+        tile_path = os.path.join(tile_dir, tile_fn)
+        return (tile_dir, tile_fn, tile_path)
+
+    def location(self, layer, tilex, tiley, zoom) -> str:
+        return self.getTilePath(layer, tilex, tiley, zoom)[2]
+
+    def has(self, layer, tilex, tiley, zoom) -> bool:
+        return os.path.exists(self.location(layer, tilex, tiley, zoom))
+
+    def lookup(self, layer, keys) -> set:
+        """ lists every column directory once instead of a stat call per tile """
+        columns = dict()
+        for (tilex, tiley, zoom) in keys:
+            columns.setdefault((tilex, zoom), []).append(tiley)
+        found = set()
+        for (tilex, zoom), tileys in columns.items():
+            tile_dir = os.path.join(self.cachedir, layer, str(zoom), str(tilex))
+            try:
+                filenames = set(os.listdir(tile_dir))
+            except OSError:
+                continue
+            for tiley in tileys:
+                if str(tiley)+".png" in filenames:
+                    found.add((tilex, tiley, zoom))
+        self.touch(layer, found)
+        return found
+
+    def _read(self, layer, tilex, tiley, zoom) -> bytes:
+        try:
+            with open(self.location(layer, tilex, tiley, zoom), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, layer, tilex, tiley, zoom, data:bytes):
+        (tile_dir, tile_fn, tile_path) = self.getTilePath(layer, tilex, tiley, zoom)
+        os.makedirs(tile_dir, exist_ok=True)
+        # write to a temporary file first, so readers never see partial tiles
+        tmp_path = "%s.%d.tmp" % (tile_path, get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, tile_path)
+
+    def _delete(self, layer, tilex, tiley, zoom):
+        try:
+            os.remove(self.location(layer, tilex, tiley, zoom))
+        except OSError:
+            pass
+
+    def _sizeof(self, layer, tilex, tiley, zoom) -> int:
+        try:
+            return os.path.getsize(self.location(layer, tilex, tiley, zoom))
+        except OSError:
+            return None
+
+    def iterTiles(self, layer):
+        layer_dir = os.path.join(self.cachedir, layer)
+        for zoom in sorted(os.listdir(layer_dir), key=lambda x: (len(x), x)):
+            if not(zoom.isdigit()):
+                continue
+            zoom_dir = os.path.join(layer_dir, zoom)
+            for tilex in os.listdir(zoom_dir):
+                if not(tilex.isdigit()):
+                    continue
+                for tile_fn in os.listdir(os.path.join(zoom_dir, tilex)):
+                    (tiley, ext) = os.path.splitext(tile_fn)
+                    if ext == ".png" and tiley.isdigit():
+                        yield (int(tilex), int(tiley), int(zoom))
+
+
+class MBTilesCache(TileCache):
+    """ tiles of each layer in cachedir/layer.mbtiles
+        tile_row is flipped (TMS scheme) as required by the MBTiles spec
+    """
+
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)",
+              "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)",
+              "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)",
+              "INSERT OR IGNORE INTO metadata VALUES ('format', 'png')"]
+
+    def __init__(self, cachedir, max_bytes=None):
+        TileCache.__init__(self, cachedir, max_bytes=max_bytes)
+        self.databases = dict()
+
+    def getPath(self, layer) -> str:
+        return os.path.join(self.cachedir, layer+".mbtiles")
+
+    def connect(self, layer) -> sqlite3.Connection:
+        """ returns the connection of the current thread to the file of layer """
+        with self.lock:
+            db = self.databases.get(layer)
+            if db is None:
+                schema = self.SCHEMA + ["INSERT OR IGNORE INTO metadata VALUES ('name', '%s')" % layer.replace("'", "''")]
+                db = SQLiteConnections(self.getPath(layer), schema)
+                self.databases[layer] = db
+        return db.connect()
+
+    @staticmethod
+    def tileRow(tiley, zoom) -> int:
+        return (2**zoom - 1) - tiley
+
+    def location(self, layer, tilex, tiley, zoom) -> str:
+        return "%s#%d/%d/%d" % (self.getPath(layer), zoom, tilex, tiley)
+
+    def has(self, layer, tilex, tiley, zoom) -> bool:
+        cursor = self.connect(layer).execute(
+            "SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (zoom, tilex, self.tileRow(tiley, zoom)))
+        return not(cursor.fetchone() is None)
+
+    def lookup(self, layer, keys) -> set:
+        """ one range query per zoom level """
+        zooms = dict()
+        for key in keys:
+            zooms.setdefault(key[2], set()).add(key)
+        conn = self.connect(layer)
+        found = set()
+        for zoom, zkeys in zooms.items():
+            xs = [key[0] for key in zkeys]
+            rows = [self.tileRow(key[1], zoom) for key in zkeys]
+            cursor = conn.execute(
+                "SELECT tile_column, tile_row FROM tiles WHERE zoom_level=? "
+                "AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                (zoom, min(xs), max(xs), min(rows), max(rows)))
+            for (tilex, tile_row) in cursor:
+                key = (tilex, self.tileRow(tile_row, zoom), zoom)
+                if key in zkeys:
+                    found.add(key)
+        self.touch(layer, found)
+        return found
+
+    def _read(self, layer, tilex, tiley, zoom) -> bytes:
+        cursor = self.connect(layer).execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (zoom, tilex, self.tileRow(tiley, zoom)))
+        row = cursor.fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _write(self, layer, tilex, tiley, zoom, data:bytes):
+        self.writeMany(layer, [(tilex, tiley, zoom, data)])
+
+    def writeMany(self, layer, tiles):
+        """ writes [(tilex, tiley, zoom, data), ...] in one transaction, without metadata """
+        conn = self.connect(layer)
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                             [(zoom, tilex, self.tileRow(tiley, zoom), sqlite3.Binary(data))
+                              for (tilex, tiley, zoom, data) in tiles])
+
+    def _delete(self, layer, tilex, tiley, zoom):
+        conn = self.connect(layer)
+        with conn:
+            conn.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                         (zoom, tilex, self.tileRow(tiley, zoom)))
+
+    def _sizeof(self, layer, tilex, tiley, zoom) -> int:
+        cursor = self.connect(layer).execute(
+            "SELECT length(tile_data) FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (zoom, tilex, self.tileRow(tiley, zoom)))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def iterTiles(self, layer):
+        cursor = self.connect(layer).execute("SELECT tile_column, tile_row, zoom_level FROM tiles")
+        for (tilex, tile_row, zoom) in cursor:
+            yield (tilex, self.tileRow(tile_row, zoom), zoom)
+
+    def close(self):
+        TileCache.close(self)
+        with self.lock:
+            databases, self.databases = self.databases, dict()
+        for db in databases.values():
+            db.close()
+
+
+### tools
+
+def migrate(source:TileCache, target:TileCache, layer, batch_size=500, progress=None) -> int:
+    """ copies all tiles of layer from source to target, returns the number of tiles copied """
+    n = 0
+    batch = []
+    def flush():
+        if hasattr(target, "writeMany"):
+            target.writeMany(layer, batch)
+        else:
+            for tile in batch:
+                target.write(layer, *tile)
+    for (tilex, tiley, zoom) in source.iterTiles(layer):
+        data = source._read(layer, tilex, tiley, zoom)
+        if data is None:
+            continue
+        batch.append((tilex, tiley, zoom, data))
+        if len(batch) >= batch_size:
+            flush()
+            n += len(batch)
+            batch = []
+            if progress:
+                progress(n)
+    if batch:
+        flush()
+        n += len(batch)
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="migrate a tile directory cache to MBTiles files")
+    parser.add_argument("cachedir", help="directory cache (cachedir/layer/z/x/y.png)")
+    parser.add_argument("layers", nargs="*", help="layers to migrate, default: all")
+    parser.add_argument("--target", default=None, help="directory of the .mbtiles files, default: cachedir")
+    args = parser.parse_args(argv)
+    source = DirectoryTileCache(args.cachedir)
+    target = MBTilesCache(args.target or args.cachedir)
+    layers = args.layers or sorted([x for x in os.listdir(args.cachedir)
+                                    if os.path.isdir(os.path.join(args.cachedir, x))])
+    for layer in layers:
+        progress = lambda n: print("\r%s: %d tiles" % (layer, n), end="", file=sys.stderr)
+        n = migrate(source, target, layer, progress=progress)
+        print("\r%s: %d tiles -> %s" % (layer, n, target.getPath(layer)))
+    target.close()
+    source.close()
+
+
+if __name__ == "__main__":
+    main()
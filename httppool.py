@@ -0,0 +1,133 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+keep-alive connection pool for tile downloads
+'''
+
+from collections import namedtuple
+from threading import Lock
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit
+
+
+# headers: http.client.HTTPMessage, case-insensitive get()
+HTTPResponse = namedtuple("HTTPResponse", ["status", "headers", "data"])
+
+# errors of a reused connection the server has already closed
+STALE_CONNECTION_ERRORS = (ConnectionResetError, BrokenPipeError, HTTPException)
+
+DEFAULT_HEADERS = {"User-Agent": "qtmaps"}
+
+
+class HTTPConnectionPool():
+    """ keeps up to pool_size idle connections per (scheme, host, port)
+        thread-safe, a connection is used by one thread at a time
+    """
+
+    def __init__(self, pool_size=4, timeout=10, headers=None):
+        self.poolSize = pool_size
+        self.timeout = timeout
+        self.headers = dict(DEFAULT_HEADERS, **(headers or {}))
+        self.idle = dict()
+        self.lock = Lock()
+        self.stats = dict(requests=0, connections=0, reused=0, errors=0)
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _getConnection(self, key):
+        """ returns (connection, reused) """
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return (connections.pop(), True)
+        (scheme, host, port) = key
+        cls = HTTPSConnection if scheme == "https" else HTTPConnection
+        conn = cls(host, port, timeout=self.timeout)
+        self._count("connections")
+        return (conn, False)
+
+    def _putConnection(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.poolSize:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def get(self, url, headers=None) -> HTTPResponse:
+        """ GET request, raises OSError or HTTPException on connection errors """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request_headers = dict(self.headers, **(headers or {}))
+        self._count("requests")
+        while True:
+            (conn, reused) = self._getConnection(key)
+            try:
+                conn.request("GET", path, headers=request_headers)
+                response = conn.getresponse()
+                data = response.read()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused:
+                    # server closed the idle connection, retry with a new one
+                    continue
+                self._count("errors")
+                raise
+            except OSError:
+                conn.close()
+                self._count("errors")
+                raise
+            if reused:
+                self._count("reused")
+            if response.will_close:
+                conn.close()
+            else:
+                self._putConnection(key, conn)
+            return HTTPResponse(response.status, response.msg, data)
+
+    def getStats(self) -> dict:
+        """ returns request and connection counters, reuse ratio = reused/requests """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["idle"] = sum([len(x) for x in self.idle.values()])
+        stats["reuse_ratio"] = stats["reused"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+_defaultPool = None
+
+def getDefaultPool() -> HTTPConnectionPool:
+    global _defaultPool
+    if _defaultPool is None:
+        _defaultPool = HTTPConnectionPool()
+    return _defaultPool
+
+
+# test
+
+def test():
+    pool = HTTPConnectionPool()
+    for y in range(2):
+        response = pool.get("http://a.tile.openstreetmap.org/1/0/%d.png" % y)
+        print(response.status, len(response.data))
+    print(pool.getStats())
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+counters and histograms of the tile pipeline, see TileSource.metrics and qtWMSView.metrics
+'''
+
+import json
+import time
+from bisect import bisect_left
+from threading import Lock
+
+
+# upper bounds of the buckets in ms
+TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram():
+    """ counts values in buckets of upper bounds, the last bucket is unbounded """
+
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ upper bound of the bucket containing the q-quantile (max for the last bucket) """
+        if not(self.count):
+            return 0.0
+        rank = q * self.count
+        n = 0
+        for (i, count) in enumerate(self.buckets):
+            n += count
+            if n >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        bounds = [str(x) for x in self.bounds] + ["inf"]
+        return dict(count=self.count, total=self.total, mean=self.total/self.count if self.count else 0.0,
+                    max=self.max, p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99),
+                    buckets=dict(zip(bounds, self.buckets)))
+
+
+class Metrics():
+    """ thread-safe named counters and histograms """
+
+    def __init__(self):
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value, bounds=TIME_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def measure(self, name):
+        """ context manager observing the time spent in its block in ms """
+        return _Measurement(self, name)
+
+    def snapshot(self) -> dict:
+        """ returns {"counters": {name: n}, "histograms": {name: {count, mean, p50, ...}}} """
+        with self.lock:
+            return dict(time=time.time(),
+                        counters=dict(self.counters),
+                        histograms=dict([(name, h.snapshot()) for (name, h) in self.histograms.items()]))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class _Measurement():
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, (time.perf_counter() - self.start) * 1000)
+
+
+def exportSnapshot(snapshot:dict, path):
+    """ writes a snapshot (or a dict of snapshots) as JSON """
+    with open(path, "w") as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+
+
+# test
+
+def test():
+    metrics = Metrics()
+    for ms in (0.5, 3, 3, 40, 700, 20000):
+        metrics.observe("download_ms", ms)
+    metrics.count("bytes", 1234)
+    with metrics.measure("redraw_ms"):
+        time.sleep(0.01)
+    print(json.dumps(metrics.snapshot(), indent=2))
+
+if __name__ == "__main__":
+    test()
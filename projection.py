@@ -0,0 +1,99 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+vectorized web mercator transforms between lon/lat, tile and scene pixel coordinates
+
+all functions accept scalars or numpy arrays (of any shape) and return the same,
+coordinates are always ordered (lon, lat) resp. (x, y)
+https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+'''
+
+from functools import lru_cache
+
+import numpy as np
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """ returns (xtile, ytile) as floats """
+    n = 2.0 ** zoom
+    lat_rad = np.radians(lat)
+    xtile = (np.asarray(lon) + 180.0) / 360.0 * n
+    ytile = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return (xtile, ytile)
+
+def tile_to_lonlat(xtile, ytile, zoom):
+    n = 2.0 ** zoom
+    lon = np.asarray(xtile) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(ytile) / n))))
+    return (lon, lat)
+
+
+class Projection():
+    """ transforms of one zoom level, scene pixels are relative to the upper left corner
+        of the origin tile (as in TileSet.upperLeftTile)
+    """
+
+    def __init__(self, zoom, origin=(0, 0), tile_size=(256, 256)):
+        self.zoom = zoom
+        self.origin = origin
+        self.tileSize = tile_size
+        # constants
+        self.n = 2.0 ** zoom
+        self.xscale = self.n / 360.0
+        self.yscale = self.n / (2.0 * np.pi)
+
+    def toTile(self, lon, lat):
+        """ lon/lat -> (xtile, ytile) as floats """
+        xtile = (np.asarray(lon) + 180.0) * self.xscale
+        ytile = self.n / 2.0 - np.arcsinh(np.tan(np.radians(lat))) * self.yscale
+        return (xtile, ytile)
+
+    def fromTile(self, xtile, ytile):
+        """ (xtile, ytile) -> (lon, lat) """
+        lon = np.asarray(xtile) / self.xscale - 180.0
+        lat = np.degrees(np.arctan(np.sinh((self.n / 2.0 - np.asarray(ytile)) / self.yscale)))
+        return (lon, lat)
+
+    def toPixel(self, lon, lat):
+        """ lon/lat -> scene pixel (x, y) """
+        (xtile, ytile) = self.toTile(lon, lat)
+        x = (xtile - self.origin[0]) * self.tileSize[0]
+        y = (ytile - self.origin[1]) * self.tileSize[1]
+        return (x, y)
+
+    def fromPixel(self, x, y):
+        """ scene pixel (x, y) -> (lon, lat) """
+        xtile = self.origin[0] + np.asarray(x) / self.tileSize[0]
+        ytile = self.origin[1] + np.asarray(y) / self.tileSize[1]
+        return self.fromTile(xtile, ytile)
+
+    def tileToPixel(self, xtile, ytile):
+        """ tile numbers -> scene pixel (x, y) of their upper left corner """
+        x = (np.asarray(xtile) - self.origin[0]) * self.tileSize[0]
+        y = (np.asarray(ytile) - self.origin[1]) * self.tileSize[1]
+        return (x, y)
+
+
+@lru_cache(maxsize=64)
+def get_projection(zoom, origin=(0, 0), tile_size=(256, 256)) -> Projection:
+    """ returns a shared Projection, the constants are computed once per arguments """
+    return Projection(zoom, origin=origin, tile_size=tile_size)
+
+
+# test
+
+def test():
+    lons = np.array([-180.0, 0.0, 11.647032, 179.9])
+    lats = np.array([85.0, 0.0, 52.139045, -85.0])
+    p = get_projection(10, origin=(540, 330))
+    (x, y) = p.toPixel(lons, lats)
+    print(x, y)
+    print(p.fromPixel(x, y))
+
+if __name__ == "__main__":
+    test()
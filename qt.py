@@ -8,18 +8,202 @@
 '''
 
 import time
+import math
+import logging
 from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt5.QtCore import Qt, pyqtSignal
-from PyQt5.Qt import QWidget, QGraphicsView, QGraphicsScene, QPixmap,\
+from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from PyQt5.Qt import QWidget, QGraphicsView, QGraphicsScene, QGraphicsItem, QPixmap, QImage,\
     QWheelEvent, QPainter, QEvent, QMouseEvent, QGraphicsSceneMouseEvent, QRectF,\
-    QCursor, QThread, QTimer
+    QCursor, QThread, QTimer, QPointF, QTransform
 
-from qtmaps.wms import TileSource, ViewRequest
-from qtmaps.qts import vbox_layout, hbox_layout
+from qtmaps.wms import TileSource, ViewRequest, TileSetEvictedError, TilePrefetcher
+from qtmaps.qts import vbox_layout, grid_layout
+from qtmaps.metrics import Metrics, exportSnapshot
 
+log = logging.getLogger(__name__)
 
 
+
+class qtTileCache():
+    """ LRU cache of decoded tiles, keyed by (layer, zoom, xtile, ytile) and 
+        bounded by the memory of the pixmaps (max_bytes) 
+        pixmaps may only be used in the GUI thread
+    """
+    
+    def __init__(self, max_bytes=256*1024*1024):
+        self.maxBytes = max_bytes
+        self.pixmaps = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        
+    @staticmethod
+    def pixmapBytes(pixmap:QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        
+    def get(self, key) -> QPixmap:
+        pixmap = self.pixmaps.get(key)
+        if pixmap is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.pixmaps.move_to_end(key)
+        return pixmap
+    
+    def put(self, key, pixmap:QPixmap):
+        if key in self.pixmaps:
+            self.nbytes -= self.pixmapBytes(self.pixmaps.pop(key))
+        self.pixmaps[key] = pixmap
+        self.nbytes += self.pixmapBytes(pixmap)
+        while self.nbytes > self.maxBytes and len(self.pixmaps) > 1:
+            (_, evicted) = self.pixmaps.popitem(last=False)
+            self.nbytes -= self.pixmapBytes(evicted)
+            
+    def clear(self):
+        self.pixmaps.clear()
+        self.nbytes = 0
+        
+    def __contains__(self, key):
+        return key in self.pixmaps
+        
+        
+_tileCache = None
+
+def getTileCache() -> qtTileCache:
+    """ returns the process-wide decoded tile cache """
+    global _tileCache
+    if _tileCache is None:
+        _tileCache = qtTileCache()
+    return _tileCache
+    
+    
+class qtTileDecoder(QObject):
+    """ decodes tiles to QImages in a pool of worker threads shared by all decoders,
+        decoded(key, image) is emitted in the thread of the decoder (the GUI thread),
+        image is None if the tile can't be read or decoded
+    """
+    
+    decoded = pyqtSignal(object, object)
+    
+    MAX_WORKERS = 4
+    executor = None
+    
+    def __init__(self, metrics:Metrics=None):
+        QObject.__init__(self)
+        if qtTileDecoder.executor is None:
+            qtTileDecoder.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="tiledecode")
+        self.metrics = metrics
+        self.pending = set()
+        self.decoded.connect(self._finished)
+        
+    def decode(self, key, read):
+        """ decodes read() (the encoded tile) in a worker thread, once per key until decoded """
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        self.executor.submit(self._decode, key, read)
+        
+    def _decode(self, key, read):
+        start = time.perf_counter()
+        image = None
+        try:
+            data = read()
+            if not(data is None):
+                image = QImage.fromData(data)
+                if image.isNull():
+                    image = None
+                else:
+                    # the native pixmap format, QPixmap.fromImage() won't have to convert
+                    fmt = QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+                    image = image.convertToFormat(fmt)
+        finally:
+            if self.metrics:
+                self.metrics.observe("decode_ms", (time.perf_counter() - start) * 1000)
+            self.decoded.emit(key, image)
+            
+    def _finished(self, key, image):
+        self.pending.discard(key)
+        
+
+class qtTileLayer(QGraphicsItem):
+    """ the tiles of one zoom level in a single item, paint() draws the tiles of the exposed rect
+        straight from their pixmaps, so the cost of a frame depends on the visible tiles only
+        tiles, placeholders: (zoom, xtile, ytile) -> (pixmap, source rect), a placeholder is drawn
+        until its tile is set
+    """
+    
+    LOD_SMOOTH = 0.5    # below this scale pixmaps are drawn unfiltered
+    
+    def __init__(self):
+        QGraphicsItem.__init__(self)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.tiles = dict()
+        self.placeholders = dict()
+        self.zoom = 0
+        self.origin = (0, 0)
+        self.tileSize = (256, 256)
+        self.rect = QRectF()
+        
+    def setGrid(self, zoom, origin, tile_size):
+        """ the tile origin is drawn at (0, 0), the bounding rect spans the world at zoom """
+        self.prepareGeometryChange()
+        self.zoom = zoom
+        self.origin = origin
+        self.tileSize = tile_size
+        n = 2**zoom
+        ((ox, oy), (tw, th)) = (origin, tile_size)
+        self.rect = QRectF(-ox*tw, -oy*th, n*tw, n*th)
+        
+    def tileRect(self, key) -> QRectF:
+        ((ox, oy), (tw, th)) = (self.origin, self.tileSize)
+        return QRectF((key[1] - ox) * tw, (key[2] - oy) * th, tw, th)
+    
+    def updateTile(self, key):
+        # QGraphicsItem.update() unites the rects of one event pass to their bounding rect,
+        # the scene keeps them apart, so tiles arriving together repaint only themselves
+        scene = self.scene()
+        if scene:
+            scene.update(self.mapRectToScene(self.tileRect(key)))
+        
+    def setTile(self, key, entry):
+        self.tiles[key] = entry
+        self.placeholders.pop(key, None)
+        self.updateTile(key)
+        
+    def setPlaceholder(self, key, entry):
+        self.placeholders[key] = entry
+        self.updateTile(key)
+        
+    def removeTiles(self, keys):
+        for key in keys:
+            tile = self.tiles.pop(key, None)
+            placeholder = self.placeholders.pop(key, None)
+            if tile or placeholder:
+                self.updateTile(key)
+        
+    def boundingRect(self) -> QRectF:
+        return self.rect
+    
+    def paint(self, painter:QPainter, option, widget=None):
+        exposed = option.exposedRect
+        ((ox, oy), (tw, th)) = (self.origin, self.tileSize)
+        (x1, y1) = (ox + math.floor(exposed.left()/tw), oy + math.floor(exposed.top()/th))
+        (x2, y2) = (ox + math.ceil(exposed.right()/tw) - 1, oy + math.ceil(exposed.bottom()/th) - 1)
+        if (x2-x1+1) * (y2-y1+1) <= len(self.tiles) + len(self.placeholders):
+            keys = [(self.zoom, x, y) for x in range(x1, x2+1) for y in range(y1, y2+1)]
+        else:
+            # zoomed out by the view transform: fewer tiles than exposed tile cells
+            keys = [k for k in list(self.placeholders) + list(self.tiles) if x1 <= k[1] <= x2 and y1 <= k[2] <= y2]
+        lod = option.levelOfDetailFromTransform(painter.worldTransform())
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, lod >= self.LOD_SMOOTH)
+        for key in keys:
+            entry = self.tiles.get(key) or self.placeholders.get(key)
+            if entry:
+                painter.drawPixmap(self.tileRect(key), *entry)
+    
+
 class qtMapScene(QGraphicsScene):
     def __init__(self):
         QGraphicsScene.__init__(self)
@@ -45,7 +229,7 @@ class qtMapView(QGraphicsView):
         self.panPos = None
         
     def redrawMap(self):
-        print("qtMapView.redrawMap()")
+        log.debug("qtMapView.redrawMap()")
         scene = self.scene()
         scene.clear()
             
@@ -67,9 +251,9 @@ class qtMapView(QGraphicsView):
         
     def changeScrollbars(self, dx, dy):
         x = self.horizontalScrollBar().value() + dx
-        self.horizontalScrollBar().setValue(x)
+        self.horizontalScrollBar().setValue(int(round(x)))
         y = self.verticalScrollBar().value() + dy
-        self.verticalScrollBar().setValue(y)
+        self.verticalScrollBar().setValue(int(round(y)))
         #print("changeScrollbars(dx=%r, dy=%r): x=%r y=%r" % (dx, dy, x, y))
         
     def panXY(self, dx, dy):
@@ -80,7 +264,7 @@ class qtMapView(QGraphicsView):
         if self.viewMode == "pan":
             #self.viewport().setCursor(QCursor(Qt.ClosedHandCursor))
             self.panPos = event.pos()
-            print("pan", self.panPos)
+            log.debug("pan %r", self.panPos)
     
     def actMiddleButton(self, event:QMouseEvent):
         pass
@@ -126,7 +310,7 @@ class qtMapView(QGraphicsView):
     def wheelEvent(self, event:QGraphicsSceneMouseEvent):
         self.scenePos = self.mapToScene(event.pos())
         self.mapPos = self.toMapPos(self.scenePos.x(), self.scenePos.y())
-        print("wheel event.pos=%r scenePos=%r mapPos=%r" % (event.pos(), self.scenePos, self.mapPos))
+        log.debug("wheel event.pos=%r scenePos=%r mapPos=%r", event.pos(), self.scenePos, self.mapPos)
         if event.angleDelta().y() > 0:
             self.actWheelUp(event)
         else:
@@ -148,7 +332,7 @@ class qtRasterView(qtMapView):
         return qtMapView.toScenePos(self, map_x, map_y)
     
     def redrawMap(self):
-        print("qtRasterView.redrawMap()")
+        log.debug("qtRasterView.redrawMap()")
         scene = self.scene()
         scene.clear() 
         scene.addPixmap(self.img_pixmap)
@@ -160,11 +344,69 @@ class qtWMSView(qtMapView):
     
     MAX_ZOOM = 19
     
-    viewChanged = pyqtSignal(float, float, int)
+    viewChanged = pyqtSignal(float, float, float)
+    # (anchor x, anchor y, zoom level) of every frame of a zoom animation
+    zoomLevelChanged = pyqtSignal(float, float, float)
+    # emitted from download threads
+    tilePrefetched = pyqtSignal(object)
+    viewTileReceived = pyqtSignal(int, int, object)
+    viewTileSetReceived = pyqtSignal(int, int)
+    streamTileReceived = pyqtSignal(int, int, object)
+    streamTilesReceived = pyqtSignal(int, int)
     
-    def __init__(self, tilesource:TileSource, initial=(0,0,3)):
+    PREFETCH_DELAY = 150    # ms after the last pan or view change
+    PLACEHOLDER_LEVELS = 3  # zoom levels searched upwards for a cached ancestor
+    STREAM_MARGIN = 1       # tiles streamed in beyond the viewport while panning
+    DROP_MARGIN = 3         # tiles further off-screen are removed from the scene
+    ZOOM_STEP = 1.0         # zoom levels per wheel notch
+    ZOOM_DURATION = 200     # ms of a zoom animation
+    ZOOM_FRAME = 16         # ms between the frames of a zoom animation
+    
+    def __init__(self, tilesource:TileSource, initial=(0,0,3), tilecache:qtTileCache=None, prefetch=True):
         qtMapView.__init__(self, initial=initial)
         self.tilesource = tilesource
+        self.tilesource.setDevicePixelRatio(self.devicePixelRatioF())
+        self.tileCache = tilecache or getTileCache()
+        self.tileLayer = qtTileLayer()  # the tiles and placeholders, added to the scene in setScene()
+        # decoding in worker threads, GUI thread and decoding time are measured in metrics
+        self.metrics = Metrics()
+        self.decoder = qtTileDecoder(metrics=self.metrics)
+        self.decoder.decoded.connect(self.handleDecoded)
+        self.decodingTiles = dict()     # (layer, zoom, xtile, ytile) -> (tileSetID, tile) placed when decoded
+        # asynchronous zoom steps
+        self.viewRequestID = None
+        self.viewTileReceived.connect(self.handleViewTile)
+        self.viewTileSetReceived.connect(self.handleViewTileSet)
+        # tiles entering the viewport while panning
+        self.streamRequests = set()
+        self.streamKeys = set()     # (zoom, xtile, ytile) requested but not arrived yet
+        self.streamRange = None     # (tileSetID, x1, y1, x2, y2) of the last streamTiles()
+        self.streamTileReceived.connect(self.handleStreamTile)
+        self.streamTilesReceived.connect(self.handleStreamTiles)
+        # prefetching
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = TilePrefetcher(tilesource, max_zoom=self.MAX_ZOOM, tileCallback=self.tilePrefetched.emit)
+        self.prefetchTimer = QTimer()
+        self.prefetchTimer.setSingleShot(True)
+        self.prefetchTimer.setInterval(self.PREFETCH_DELAY)
+        self.prefetchTimer.timeout.connect(self.prefetch)
+        self.tilePrefetched.connect(self.decodePrefetched)
+        # smooth zoom: the tiles of mapZoom are scaled by the view transform to the fractional
+        # zoomLevel, the tiles of the nearest zoom level are loaded when the animation ends
+        self.zoomLevel = float(self.mapZoom)
+        self.anchorPos = None   # view position of mapPos if viewAnchor is "mouse"
+        self.zoomAnimation = None   # (start time, start level, target level, anchor)
+        self.zoomTimer = QTimer()
+        self.zoomTimer.setInterval(self.ZOOM_FRAME)
+        self.zoomTimer.timeout.connect(self.animateZoom)
+        
+    def setScene(self, scene:QGraphicsScene):
+        if self.tileLayer.scene():
+            self.tileLayer.scene().removeItem(self.tileLayer)
+        self.tileLayer = qtTileLayer()
+        scene.addItem(self.tileLayer)
+        QGraphicsView.setScene(self, scene)
         
     def toMapPos(self, scene_x, scene_y):
         return self.tilesource.pixelToCoord(pixel_x=scene_x, pixel_y=scene_y, zoom=self.mapZoom)
@@ -175,63 +417,390 @@ class qtWMSView(qtMapView):
     def adjustScrollbars(self):
         """ adjust scrollbars """
         (sx, sy) = self.toScenePos(*self.mapPos)
+        scale = self.getScale()
         if self.viewAnchor == "center":
             vx, vy = self.width()/2, self.height()/2
-            dx, dy = sx-vx, sy-vy
         elif self.viewAnchor == "mouse":
-            pass
+            vx, vy = self.anchorPos.x(), self.anchorPos.y()
         else:
             raise NotImplementedError
-        self.horizontalScrollBar().setValue(dx)
-        self.verticalScrollBar().setValue(dy)
+        dx, dy = sx*scale-vx, sy*scale-vy
+        self.horizontalScrollBar().setValue(int(round(dx)))
+        self.verticalScrollBar().setValue(int(round(dy)))
         
         
     def redrawMap(self):
-        print("qtWMSView.redrawMap()")
+        log.debug("qtWMSView.redrawMap()")
+        with self.metrics.measure("redraw_ms"):
+            self._redrawMap()
+            
+    def _redrawMap(self):
+        self.cancelStreaming()
         self.resetScrollbars()
-        scene = self.scene()
-        scene.clear()
         tileSet = self.tilesource.getActiveTileSet()
+        layer = self.tilesource.getLayerName()
+        # the scene spans the world at this zoom level, so panning is not limited to the tile set
+        tileLayer = self.tileLayer
+        (tw, th) = (self.tilesource.tileWidth, self.tilesource.tileHeight)
+        tileLayer.setGrid(tileSet.zoom, (tileSet.upperLeftTile.xtile, tileSet.upperLeftTile.ytile), (tw, th))
+        self.scene().setSceneRect(tileLayer.boundingRect())
+        # keep the tiles still in view, add new ones, drop the rest
+        # tiles not decoded yet are drawn from cached ancestors or children
+        tiles = dict()
+        placeholders = dict()
         for row in tileSet.tiles:
             for tile in row:
-                if tile.path is None: 
+                key = (tile.zoom, tile.xtile, tile.ytile)
+                entry = tileLayer.tiles.get(key) or self.createTileEntry(tile, layer)
+                if entry:
+                    tiles[key] = entry
                     continue
-                pixmap = QPixmap()
-                pixmap.load(tile.path)
-                item = scene.addPixmap(pixmap)
-                item.setPos(tile.sceneX, tile.sceneY)
+                if tile.path:
+                    self.decodeTile(self.tilesource.tileSetID, tile, layer)
+                entry = tileLayer.placeholders.get(key) or self.createPlaceholder(tile, layer)
+                if entry:
+                    placeholders[key] = entry
+        tileLayer.tiles = tiles
+        tileLayer.placeholders = placeholders
+        tileLayer.update()
+        scale = self.getScale()
+        self.setTransform(QTransform.fromScale(scale, scale))
         self.adjustScrollbars()
         
+    def createTileEntry(self, tile, layer):
+        """ returns (pixmap, source rect) of tile for the tile layer, None if the tile is not decoded yet """
+        key = (layer, tile.zoom, tile.xtile, tile.ytile)
+        if not(key in self.tileCache):
+            return None
+        pixmap = self.tileCache.get(key)
+        return (pixmap, QRectF(pixmap.rect()))
+    
+    def decodeTile(self, tileSetID, tile, layer):
+        """ decodes tile in a worker thread and places it when done """
+        key = (layer, tile.zoom, tile.xtile, tile.ytile)
+        self.decodingTiles[key] = (tileSetID, tile)
+        read = lambda: self.tilesource.readTile(tile.xtile, tile.ytile, tile.zoom)
+        self.decoder.decode(key, read)
+        
+    def handleDecoded(self, key, image):
+        """ converts the decoded tile to a pixmap (the only GUI thread part of decoding) """
+        entry = self.decodingTiles.pop(key, None)
+        if image is None:
+            return
+        if not(key in self.tileCache):
+            with self.metrics.measure("convert_ms"):
+                self.tileCache.put(key, QPixmap.fromImage(image))
+        if entry:
+            self.placeTile(*entry)
+    
+    def createPlaceholder(self, tile, layer):
+        """ returns (pixmap, source rect) for a tile that is not available yet:
+            the quadrant of the nearest cached ancestor, or else
+            a mosaic of the children in the tile cache
+            returns None if neither is cached
+        """
+        for dz in range(1, min(self.PLACEHOLDER_LEVELS, tile.zoom)+1):
+            zoom = tile.zoom - dz
+            f = 2**dz
+            key = (layer, zoom, tile.xtile // f, tile.ytile // f)
+            if not(key in self.tileCache):
+                continue
+            pixmap = self.tileCache.get(key)
+            (w, h) = (pixmap.width() / f, pixmap.height() / f)
+            return (pixmap, QRectF((tile.xtile % f) * w, (tile.ytile % f) * h, w, h))
+        return self.createMosaic(tile, layer)
+    
+    def createMosaic(self, tile, layer):
+        """ paints the children of tile found in the tile cache into one pixmap of the tile image size """
+        children = []
+        for (dx, dy) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            key = (layer, tile.zoom+1, 2*tile.xtile+dx, 2*tile.ytile+dy)
+            if key in self.tileCache:
+                children.append((dx, dy, self.tileCache.get(key)))
+        if not(children):
+            return None
+        size = self.tilesource.tileSize
+        pixmap = QPixmap(size, size)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        w = size / 2
+        for (dx, dy, child) in children:
+            painter.drawPixmap(QRectF(dx*w, dy*w, w, w), child, QRectF(child.rect()))
+        painter.end()
+        return (pixmap, QRectF(pixmap.rect()))
+    
+    def placeTile(self, tileSetID, tile):
+        """ adds a tile that has arrived after redrawMap, if its tile set is displayed """
+        if tileSetID != self.tilesource.tileSetID or tile.path is None:
+            return
+        key = (tile.zoom, tile.xtile, tile.ytile)
+        if key in self.tileLayer.tiles:
+            return
+        layer = self.tilesource.getLayerName()
+        with self.metrics.measure("place_ms"):
+            entry = self.createTileEntry(tile, layer)
+            if entry:
+                self.tileLayer.setTile(key, entry)
+        if entry is None:
+            self.decodeTile(tileSetID, tile, layer)
+        
+    def getMetrics(self) -> dict:
+        """ snapshot of the view metrics (redraw, place, convert and decode time in ms)
+            and the counters of the pixmap cache
+        """
+        snapshot = self.metrics.snapshot()
+        tileCache = self.tileCache
+        snapshot["pixmap_cache"] = dict(hits=tileCache.hits, misses=tileCache.misses,
+                                        pixmaps=len(tileCache.pixmaps), bytes=tileCache.nbytes)
+        return snapshot
+    
+    def exportMetrics(self, path):
+        """ writes the metrics of the view and its tile source as JSON """
+        exportSnapshot(dict(view=self.getMetrics(), tilesource=self.tilesource.getMetrics()), path)
+        
     def update(self, *args, **kwargs):
-        print("qtWMSView.update()")
+        log.debug("qtWMSView.update()")
         QGraphicsView.update(self, *args, **kwargs)
         #self.redrawMap()
-        self.centerMap(coord=self.mapPos, zoom=self.mapZoom)
+        self.centerMap(coord=self.mapPos, zoom=self.zoomLevel)
+        
+    def setZoom(self, zoom):
+        """ sets the displayed zoom level, tiles are displayed of the nearest integer level """
+        self.zoomLevel = min(max(float(zoom), 0.0), float(self.MAX_ZOOM))
+        self.mapZoom = math.floor(self.zoomLevel + 0.5)
+        
+    def getScale(self):
+        """ scale of the view transform, the tiles of mapZoom are displayed at zoomLevel """
+        return 2.0 ** (self.zoomLevel - self.mapZoom)
+    
+    def getCenter(self):
+        """ returns (lon, lat) of the view center """
+        pos = self.viewportTransform().inverted()[0].map(QPointF(self.width()/2, self.height()/2))
+        return tuple([float(x) for x in self.toMapPos(pos.x(), pos.y())])
         
     def changeView(self, lon, lat, zoom, tileSetID=None):
-        self.mapPos = (lon, lat)
-        self.mapZoom = zoom
+        """ displays the tile set tileSetID, without one the tiles are requested in the background,
+            zoom may be fractional
+        """
+        if not(tileSetID is None):
+            try:
+                self.tilesource.setActiveTileSet(tileSetID)
+            except TileSetEvictedError as e:
+                log.info("changeView(): %s, reloading", e)
+                tileSetID = None
         if tileSetID is None:
-            vs = self.size()
-            vw, vh = vs.width(), vs.height()
-            self.tilesource.loadTiles(lon=lon, lat=lat, zoom=zoom, w1=vw/2, w2=vw/2, h1=vh/2, h2=vh/2)
+            self.requestView(lon, lat, zoom)
+            return
+        self.cancelViewRequest()
+        self.mapPos = (lon, lat)
+        self.setZoom(zoom)
+        self.redrawMap()
+        if self.prefetcher:
+            self.prefetchTimer.start()
+            
+    def requestView(self, lon, lat, zoom):
+        """ changes the view without waiting for the tiles, they are placed as they arrive
+            and placeholders are drawn meanwhile
+        """
+        self.cancelViewRequest()
+        self.mapPos = (lon, lat)
+        self.setZoom(zoom)
+        vs = self.size()
+        vw, vh = vs.width(), vs.height()
+        if self.viewAnchor == "mouse":
+            (ax, ay) = (self.anchorPos.x(), self.anchorPos.y())
         else:
-            self.tilesource.setActiveTileSet(tileSetID)
+            (ax, ay) = (vw/2, vh/2)
+        # the viewport in scene pixels of the tiles
+        scale = self.getScale()
+        (requestID, tileSetID) = self.tilesource.requestTileSet(lon=lon, lat=lat, zoom=self.mapZoom,
+                                                                w1=ax/scale, w2=(vw-ax)/scale,
+                                                                h1=ay/scale, h2=(vh-ay)/scale,
+                                                                callback=self.viewTileSetReceived.emit,
+                                                                tileCallback=self.viewTileReceived.emit)
+        self.viewRequestID = requestID
+        self.tilesource.setActiveTileSet(tileSetID)
         self.redrawMap()
+        if self.prefetcher:
+            self.prefetchTimer.start()
+            
+    def cancelViewRequest(self):
+        if not(self.viewRequestID is None):
+            self.tilesource.cancelRequest(self.viewRequestID)
+            self.viewRequestID = None
+            
+    def handleViewTile(self, requestID, tileSetID, tile):
+        if requestID == self.viewRequestID:
+            self.placeTile(tileSetID, tile)
+            
+    def handleViewTileSet(self, requestID, tileSetID):
+        if requestID == self.viewRequestID:
+            self.viewRequestID = None
+        self.tilesource.unpinTileSet(tileSetID)
+        
+    def changeScrollbars(self, dx, dy):
+        qtMapView.changeScrollbars(self, dx, dy)
+        self.streamTiles()
+        
+    def visibleTileRange(self, margin=0):
+        """ returns (x1, y1, x2, y2) of the tiles in the viewport, extended by margin tiles """
+        tileSet = self.tilesource.getActiveTileSet()
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        (tw, th) = (self.tilesource.tileWidth, self.tilesource.tileHeight)
+        (ox, oy) = (tileSet.upperLeftTile.xtile, tileSet.upperLeftTile.ytile)
+        return (ox + math.floor(rect.left()/tw) - margin, oy + math.floor(rect.top()/th) - margin,
+                ox + math.floor(rect.right()/tw) + margin, oy + math.floor(rect.bottom()/th) + margin)
+        
+    def streamTiles(self):
+        """ requests the tiles entering the viewport and drops the tiles far off-screen """
+        if self.tilesource.tileSetID is None or self.scene() is None:
+            return
+        tileSetID = self.tilesource.tileSetID
+        tileRange = self.visibleTileRange(self.STREAM_MARGIN)
+        if self.streamRange == (tileSetID,) + tileRange:
+            return
+        self.streamRange = (tileSetID,) + tileRange
+        tileSet = self.tilesource.getActiveTileSet()
+        layer = self.tilesource.getLayerName()
+        missing = []
+        skip = self.streamKeys.union(self.tileLayer.tiles)
+        for tile in self.tilesource.planTileRange(tileSet, *tileRange, skip=skip):
+            key = (tile.zoom, tile.xtile, tile.ytile)
+            if (layer,)+key in self.tileCache:
+                tile.path = self.tilesource.cache.location(layer, tile.xtile, tile.ytile, tile.zoom)
+                self.placeTile(tileSetID, tile)
+                continue
+            if not(key in self.tileLayer.placeholders):
+                entry = self.createPlaceholder(tile, layer)
+                if entry:
+                    self.tileLayer.setPlaceholder(key, entry)
+            self.streamKeys.add(key)
+            missing.append(tile)
+        self.dropTiles()
+        if missing:
+            requestID = self.tilesource.requestTileList(missing, tileSetID, callback=self.streamTilesReceived.emit,
+                                                        tileCallback=self.streamTileReceived.emit)
+            self.streamRequests.add(requestID)
+            
+    def dropTiles(self):
+        """ removes tiles and placeholders more than DROP_MARGIN tiles off-screen from the tile layer """
+        (x1, y1, x2, y2) = self.visibleTileRange(self.DROP_MARGIN)
+        keys = list(self.tileLayer.tiles) + list(self.tileLayer.placeholders)
+        self.tileLayer.removeTiles([k for k in keys if not(x1 <= k[1] <= x2 and y1 <= k[2] <= y2)])
+                
+    def cancelStreaming(self):
+        for requestID in self.streamRequests:
+            self.tilesource.cancelRequest(requestID)
+        self.streamRequests = set()
+        self.streamKeys = set()
+        self.streamRange = None
+        
+    def handleStreamTile(self, requestID, tileSetID, tile):
+        if requestID in self.streamRequests:
+            self.streamKeys.discard((tile.zoom, tile.xtile, tile.ytile))
+            self.placeTile(tileSetID, tile)
+            
+    def handleStreamTiles(self, requestID, tileSetID):
+        self.streamRequests.discard(requestID)
+        
+    def panXY(self, dx, dy):
+        qtMapView.panXY(self, dx, dy)
+        if self.prefetcher:
+            self.prefetcher.addPan(dx, dy)
+            self.prefetchTimer.start()
+            
+    def prefetch(self):
+        """ prefetches tiles around the center of the viewport, see TilePrefetcher """
+        if self.prefetcher is None or self.tilesource.tileSetID is None:
+            return
+        vr = self.viewport().rect()
+        center = self.mapToScene(vr.center())
+        (lon, lat) = self.toMapPos(center.x(), center.y())
+        scale = self.getScale()
+        self.prefetcher.prefetch(lon, lat, self.mapZoom, vr.width()/scale, vr.height()/scale)
+        
+    def decodePrefetched(self, tile):
+        """ decodes a prefetched tile into the tile cache """
+        key = (self.tilesource.getLayerName(), tile.zoom, tile.xtile, tile.ytile)
+        if not(key in self.tileCache):
+            read = lambda: self.tilesource.readTile(tile.xtile, tile.ytile, tile.zoom)
+            self.decoder.decode(key, read)
         
     def centerMap(self, coord, zoom):
         self.changeView(*coord, zoom)
         self.viewChanged.emit(*coord, zoom)
         
     def zoomIn(self):
-        print("zoomIn()")
-        self.mapZoom = min(self.mapZoom+1, self.MAX_ZOOM)
-        self.centerMap(self.mapPos, self.mapZoom)
+        log.debug("zoomIn()")
+        self.zoomAt(QPointF(self.width()/2, self.height()/2), 1)
         
     def zoomOut(self):
-        print("zoomOut()")
-        self.mapZoom = max(0, self.mapZoom-1)
-        self.centerMap(self.mapPos, self.mapZoom)
+        log.debug("zoomOut()")
+        self.zoomAt(QPointF(self.width()/2, self.height()/2), -1)
+        
+    def wheelEvent(self, event:QWheelEvent):
+        self.zoomAt(QPointF(event.pos()), event.angleDelta().y() / 120 * self.ZOOM_STEP)
+        
+    def zoomAt(self, pos:QPointF, levels):
+        """ animated zoom by levels (may be fractional), the map point under pos (view position) 
+            stays in place, repeated calls during the animation add up
+        """
+        target = self.zoomAnimation[2] if self.zoomAnimation else self.zoomLevel
+        target = min(max(target + levels, 0.0), float(self.MAX_ZOOM))
+        self.zoomAnimation = (time.perf_counter(), self.zoomLevel, target, QPointF(pos))
+        self.zoomTimer.start()
+        
+    def animateZoom(self):
+        (start, level, target, anchor) = self.zoomAnimation
+        t = min((time.perf_counter() - start) * 1000 / self.ZOOM_DURATION, 1.0)
+        # ease out
+        self.setZoomLevel(level + (target - level) * (1 - (1 - t)**3), anchor)
+        if t >= 1.0:
+            self.zoomTimer.stop()
+            self.zoomAnimation = None
+            self.loadZoomLevel(anchor)
+            
+    def setZoomLevel(self, zoom, anchor:QPointF=None):
+        """ scales the displayed tiles to the fractional zoom level by the view transform,
+            the scene point under anchor (view position, default: center) stays in place,
+            no tiles are loaded, see loadZoomLevel()
+        """
+        zoom = min(max(float(zoom), 0.0), float(self.MAX_ZOOM))
+        if zoom == self.zoomLevel:
+            return
+        if anchor is None:
+            anchor = QPointF(self.width()/2, self.height()/2)
+        scenePos = self.viewportTransform().inverted()[0].map(anchor)
+        self.zoomLevel = zoom
+        scale = self.getScale()
+        self.setTransform(QTransform.fromScale(scale, scale))
+        pos = self.viewportTransform().map(scenePos)
+        qtMapView.changeScrollbars(self, pos.x() - anchor.x(), pos.y() - anchor.y())
+        self.zoomLevelChanged.emit(anchor.x(), anchor.y(), zoom)
+        
+    def followZoomLevel(self, x, y, zoom):
+        """ zoomLevelChanged of a linked view """
+        self.setZoomLevel(zoom, QPointF(x, y))
+        
+    def loadZoomLevel(self, anchor:QPointF=None):
+        """ requests the tiles of the integer zoom level nearest to zoomLevel, the map point
+            under anchor stays in place, the scaled tiles are displayed until they arrive
+        """
+        if math.floor(self.zoomLevel + 0.5) == self.mapZoom:
+            self.streamTiles()
+        else:
+            if anchor is None:
+                anchor = QPointF(self.width()/2, self.height()/2)
+            scenePos = self.viewportTransform().inverted()[0].map(anchor)
+            (lon, lat) = self.toMapPos(scenePos.x(), scenePos.y())
+            (self.viewAnchor, self.anchorPos) = ("mouse", anchor)
+            try:
+                self.requestView(float(lon), float(lat), self.zoomLevel)
+            finally:
+                (self.viewAnchor, self.anchorPos) = ("center", None)
+        self.mapPos = self.getCenter()
+        self.viewChanged.emit(*self.mapPos, self.zoomLevel)
         
 
           
@@ -248,6 +817,10 @@ class qtTileSourceThread(QThread):
       
 class qtWmsMap(QWidget):
     
+    # emitted from tile source threads, handled in the GUI thread
+    tileSetReceived = pyqtSignal(int, int)
+    tileReceived = pyqtSignal(int, int, object)
+    
     def __init__(self, name, tilesource:TileSource, initial=(10,50,10)):
         QWidget.__init__(self)
         self.name = name
@@ -259,90 +832,145 @@ class qtWmsMap(QWidget):
         layout = vbox_layout(self.view)
         self.setLayout(layout)
         self.view.update()
-        self.viewRequestsTimer = QTimer()
-        self.viewRequestsTimer.setInterval(500)
-        self.viewRequestsTimer.timeout.connect(self.controlViewRequests)
-        self.viewRequestsTimer.start()
+        self.tileSetReceived.connect(self.handleTileSourceResponse)
+        self.tileReceived.connect(self.handleTile)
+        # the head request is displayed until its dwell timer fires
+        self.dwellTimer = QTimer()
+        self.dwellTimer.setSingleShot(True)
+        self.dwellTimer.timeout.connect(self.controlViewRequests)
         
     def getName(self):
         return self.name
     
-    def centerNext(self, coord, zoom, wait=0):
+    def centerNext(self, coord, zoom, wait=0, replace=False):
+        """ queues a view request, replace: cancel all pending requests first """
+        if replace:
+            self.resetViewRequests()
         vs = self.view.size()
         vw, vh = vs.width(), vs.height()
         kwargs = dict(lon=coord[0], lat=coord[1], zoom=zoom, w1=vw/2, w2=vw/2, h1=vh/2, h2=vh/2)
-        requestID = self.tilesource.requestTiles(**kwargs, callback=self.handleTileSourceResponse)
-        print("%r.centerNext(): rquestID=%r" % (self.getName(), requestID))
-        self.viewRequests[requestID] = ViewRequest(coord, zoom, wait, requestID, None, 
-                                                   created=time.time(), displayed=None)
+        requestID = self.tilesource.requestTiles(**kwargs, callback=self.tileSetReceived.emit,
+                                                 tileCallback=self.tileReceived.emit)
+        log.debug("%r.centerNext(): requestID=%r", self.getName(), requestID)
+        request = ViewRequest(coord, zoom, wait, requestID, None, created=time.time(), displayed=None)
+        self.viewRequests[requestID] = request
+        QTimer.singleShot(int(request.timeout*1000)+1, self.controlViewRequests)
                                      
     def handleTileSourceResponse(self, requestID, tileSetID):
         if requestID in self.viewRequests:
-            print("#1", tileSetID, self.viewRequests[requestID])
+            log.debug("handleTileSourceResponse(): tileSetID=%r %r", tileSetID, self.viewRequests[requestID])
             self.viewRequests[requestID].tileSetID = tileSetID
+            self.viewRequests[requestID].complete = True
+            self.controlViewRequests()
         else:
-            print("handleTileSourceResponse(): requestID unknown")
+            log.debug("handleTileSourceResponse(): requestID %r unknown", requestID)
+            self.tilesource.unpinTileSet(tileSetID)
             
-    def controlViewRequests(self):
-        n_requests = len(list(self.viewRequests))
-        if n_requests == 0:
+    def handleTile(self, requestID, tileSetID, tile):
+        """ a single tile of a request is available, the request may be displayed before it is complete """
+        if not(requestID in self.viewRequests):
             return
-        requestID = next(iter(self.viewRequests))
         request = self.viewRequests[requestID]
         if request.tileSetID is None:
-            if (time.time() - request.created) > request.timeout:
-                print("controlViewRequests(): remove:", requestID, ", remaining:", n_requests-1)
-                self.viewRequests.pop(requestID)
-                #self.controlViewRequests()
+            request.tileSetID = tileSetID
+            self.controlViewRequests()
+        self.view.placeTile(tileSetID, tile)
+            
+    def removeViewRequest(self, requestID):
+        """ removes the request, releases its tile set if the tile source has finished it 
+            or cancels the tiles not yet fetched
+        """
+        request = self.viewRequests.pop(requestID)
+        if request.complete:
+            self.tilesource.unpinTileSet(request.tileSetID)
         else:
+            self.tilesource.cancelRequest(requestID)
+            
+    def controlViewRequests(self):
+        """ displays and removes requests from the head of the queue until one has to wait,
+            called whenever a request, tile set, dwell or timeout event arrives
+        """
+        while self.viewRequests:
+            requestID = next(iter(self.viewRequests))
+            request = self.viewRequests[requestID]
+            current_time = time.time()
+            timedOut = (current_time - request.created) > request.timeout
+            if request.tileSetID is None:
+                if not(timedOut):
+                    return
+                log.debug("controlViewRequests(): remove: %r, remaining: %d", requestID, len(self.viewRequests)-1)
+                self.removeViewRequest(requestID)
+                continue
             if request.displayed is None:
-                print("controlViewRequests(): display:", requestID)
+                log.debug("controlViewRequests(): display: %r", requestID)
                 self.view.changeView(*request.coord, request.zoom, tileSetID=request.tileSetID)
-                request.displayed = time.time()
-            else:    
-                if (time.time() - request.displayed) > request.wait:
-                    print("controlViewRequests(): remove:", requestID, ", remaining:", n_requests-1)
-                    self.viewRequests.pop(requestID)
-                    #self.controlViewRequests()
+                request.displayed = current_time
+            if request.complete:
+                remaining = request.wait - (current_time - request.displayed)
+                if remaining > 0:
+                    self.dwellTimer.start(int(remaining*1000)+1)
+                    return
+                log.debug("controlViewRequests(): remove: %r, remaining: %d", requestID, len(self.viewRequests)-1)
+                self.removeViewRequest(requestID)
+            elif timedOut:
+                log.debug("controlViewRequests(): incomplete, remove: %r, remaining: %d", requestID, len(self.viewRequests)-1)
+                self.removeViewRequest(requestID)
+            else:
+                return
             
     def resetViewRequests(self):
-        self.viewRequests = OrderedDict() 
+        self.dwellTimer.stop()
+        for requestID in list(self.viewRequests):
+            self.removeViewRequest(requestID)
     
 
-class qtTwinWmsMap(QWidget):
-    def __init__(self, tilesource1, tilesource2, mapsize=(256, 256), align="vertical", initial=(0,0,0)):
+class qtLinkedWmsMaps(QWidget):
+    """ grid of maps of any number of tile sources sharing one pan and zoom state
+        a view change in one map is requested in the background by all others,
+        the tile sources share the download scheduler (TileDownloader or AsyncTileFetcher)
+    """
+    
+    def __init__(self, tilesources, columns=2, mapsize=(256, 256), initial=(0,0,0)):
         QWidget.__init__(self)
-        self.tileSource1 = tilesource1
-        self.tileSource2 = tilesource2
-        self.wmsMap1 = qtWmsMap(name=tilesource1.getName(), tilesource=self.tileSource1, initial=initial)
-        self.wmsMap2 = qtWmsMap(name=tilesource2.getName(), tilesource=self.tileSource2, initial=initial)
-        if mapsize:
-            self.wmsMap1.setMaximumSize(*mapsize)
-            self.wmsMap2.setMaximumSize(*mapsize)
-            self.wmsMap1.view.resize(*mapsize)
-            self.wmsMap2.view.resize(*mapsize)
-        self.wmsMap1.view.viewChanged.connect(self.wmsMap2.view.changeView)
-        self.wmsMap1.view.scrollbarsChanged.connect(self.wmsMap2.view.changeScrollbars)
-        self.wmsMap2.view.viewChanged.connect(self.wmsMap1.view.changeView)
-        self.wmsMap2.view.scrollbarsChanged.connect(self.wmsMap1.view.changeScrollbars)
-        if align == "vertical":
-            self.layout0 = vbox_layout(self.wmsMap1, self.wmsMap2)
-        else:
-            self.layout0 = hbox_layout(self.wmsMap1, self.wmsMap2)
-        self.setLayout(self.layout0)
-        print("map1: %r %r %r %r" % (self.wmsMap1.size(), self.wmsMap1.view.size(), self.wmsMap1.view.viewport().size(),
-                                     self.wmsMap1.scene.sceneRect()))
-
+        self.tileSources = list(tilesources)
+        self.wmsMaps = []
+        for tilesource in self.tileSources:
+            wmsMap = qtWmsMap(name=tilesource.getName(), tilesource=tilesource, initial=initial)
+            if mapsize:
+                wmsMap.setMaximumSize(*mapsize)
+                wmsMap.view.resize(*mapsize)
+            self.wmsMaps.append(wmsMap)
+        for wmsMap in self.wmsMaps:
+            for other in self.wmsMaps:
+                if not(other is wmsMap):
+                    wmsMap.view.viewChanged.connect(other.view.changeView)
+                    wmsMap.view.zoomLevelChanged.connect(other.view.followZoomLevel)
+                    wmsMap.view.scrollbarsChanged.connect(other.view.changeScrollbars)
+        self.layout0 = grid_layout(self, [(i // columns, i % columns, wmsMap) for (i, wmsMap) in enumerate(self.wmsMaps)])
+        
     def centerMap(self, coord, zoom):
-        self.wmsMap1.view.centerMap(coord, zoom)
+        self.wmsMaps[0].view.centerMap(coord, zoom)
         
     def centerNext(self, coord, zoom, wait):
-        self.wmsMap1.centerNext(coord, zoom, wait)
-        self.wmsMap2.centerNext(coord, zoom, wait)
+        for wmsMap in self.wmsMaps:
+            wmsMap.centerNext(coord, zoom, wait)
     
     def resetViewRequests(self):
-        self.wmsMap1.resetViewRequests()
-        self.wmsMap2.resetViewRequests()
+        for wmsMap in self.wmsMaps:
+            wmsMap.resetViewRequests()
+            
+
+class qtTwinWmsMap(qtLinkedWmsMaps):
+    def __init__(self, tilesource1, tilesource2, mapsize=(256, 256), align="vertical", initial=(0,0,0)):
+        columns = 1 if align == "vertical" else 2
+        qtLinkedWmsMaps.__init__(self, [tilesource1, tilesource2], columns=columns, mapsize=mapsize, initial=initial)
+        self.tileSource1 = tilesource1
+        self.tileSource2 = tilesource2
+        (self.wmsMap1, self.wmsMap2) = self.wmsMaps
+        log.debug("map1: %r %r %r %r", self.wmsMap1.size(), self.wmsMap1.view.size(), self.wmsMap1.view.viewport().size(),
+                  self.wmsMap1.scene.sceneRect())
+        
+        
 # test
 
 def test():
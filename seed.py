@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+offline cache seeding: downloads all tiles of a region and zoom range into the cache
+
+python -m qtmaps.seed CACHEDIR --source osm --bbox 11.5 52.0 11.8 52.2 --zoom 10 15
+python -m qtmaps.seed CACHEDIR --source osm --polygon region.geojson --zoom 10 15
+
+tiles already cached are skipped, so an interrupted run is resumed by starting it again
+'''
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import numpy as np
+
+from qtmaps.wms import TileSource, TileRequest, OSMTileSource, OSMTileSourceA, OSMTileSourceB, OSMTileSourceC,\
+    StamenTonerTileSource, PRIORITY_SEED
+from qtmaps.projection import lonlat_to_tile
+from qtmaps.synthetic import SyntheticTileSource
+
+
+SOURCES = {"osm": OSMTileSource,
+           "osm-a": OSMTileSourceA,
+           "osm-b": OSMTileSourceB,
+           "osm-c": OSMTileSourceC,
+           "stamen-toner": StamenTonerTileSource,
+           "synthetic": SyntheticTileSource}
+
+
+class UrlTileSource(TileSource):
+    """ tile source of a url template with {x}, {y} and {z} """
+
+    def __init__(self, name, cachedir, url, download_delay=1, **kwargs):
+        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=download_delay, **kwargs)
+        self.SRC_NAME = name
+        self.TILE_URL = url
+
+
+def tileRange(lon1, lat1, lon2, lat2, zoom):
+    """ returns (x1, y1, x2, y2) of the tiles covering the bbox, clipped to the world """
+    n = 2**zoom
+    (xs, ys) = lonlat_to_tile(np.array([lon1, lon2]), np.clip([lat1, lat2], -85.0511, 85.0511), zoom)
+    x1, x2 = [int(np.clip(np.floor(x), 0, n-1)) for x in (min(xs), max(xs))]
+    y1, y2 = [int(np.clip(np.floor(y), 0, n-1)) for y in (min(ys), max(ys))]
+    return (x1, y1, x2, y2)
+
+def planBBox(lon1, lat1, lon2, lat2, zooms) -> list:
+    """ returns [(tilex, tiley, zoom), ...] of the bbox in all zoom levels """
+    keys = []
+    for zoom in zooms:
+        (x1, y1, x2, y2) = tileRange(lon1, lat1, lon2, lat2, zoom)
+        keys.extend([(x, y, zoom) for x in range(x1, x2+1) for y in range(y1, y2+1)])
+    return keys
+
+def insidePolygon(px, py, polygon):
+    """ even-odd rule for arrays of points, polygon: (xs, ys) arrays of the ring """
+    (xs, ys) = polygon
+    inside = np.zeros(np.shape(px), dtype=bool)
+    for i in range(len(xs)):
+        (x1, y1, x2, y2) = (xs[i-1], ys[i-1], xs[i], ys[i])
+        if y1 == y2:
+            continue
+        crosses = (y1 > py) != (y2 > py)
+        xcross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (px < xcross)
+    return inside
+
+def planPolygon(ring, zooms) -> list:
+    """ returns the tiles whose center or a corner lies inside the ring [(lon, lat), ...]
+        plus the tiles of its vertices, in all zoom levels
+    """
+    ring = np.asarray(ring, dtype=float)
+    (lons, lats) = (ring[:,0], np.clip(ring[:,1], -85.0511, 85.0511))
+    keys = []
+    for zoom in zooms:
+        polygon = lonlat_to_tile(lons, lats, zoom)
+        (x1, y1, x2, y2) = tileRange(lons.min(), lats.min(), lons.max(), lats.max(), zoom)
+        (tx, ty) = np.meshgrid(np.arange(x1, x2+1), np.arange(y1, y2+1), indexing="ij")
+        selected = np.zeros(tx.shape, dtype=bool)
+        for (dx, dy) in ((0.5, 0.5), (0, 0), (1, 0), (0, 1), (1, 1)):
+            selected |= insidePolygon(tx+dx, ty+dy, polygon)
+        n = 2**zoom
+        for (x, y) in zip(*[np.clip(np.floor(v), 0, n-1).astype(int) for v in polygon]):
+            selected[x-x1, y-y1] = True
+        keys.extend([(int(x), int(y), zoom) for (x, y) in zip(tx[selected], ty[selected])])
+    return keys
+
+def readPolygon(path) -> list:
+    """ returns the outer ring of the first polygon of a GeoJSON file (geometry, feature or collection) """
+    with open(path) as f:
+        geojson = json.load(f)
+    if geojson["type"] == "FeatureCollection":
+        geojson = geojson["features"][0]
+    if geojson["type"] == "Feature":
+        geojson = geojson["geometry"]
+    if geojson["type"] == "Polygon":
+        return geojson["coordinates"][0]
+    if geojson["type"] == "MultiPolygon":
+        return geojson["coordinates"][0][0]
+    raise ValueError("no polygon in %r" % path)
+
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def printProgress(stats):
+    eta = formatDuration(stats["eta"]) if stats["eta"] is not None else "-"
+    print("\r%d/%d tiles, %d failed, %.1f tiles/s, ETA %s " % (stats["done"], stats["total"], stats["failed"],
+                                                                stats["rate"], eta), end="", file=sys.stderr)
+
+
+def seed(tilesource:TileSource, keys, max_pending=64, progress=None, interval=1.0) -> dict:
+    """ downloads all keys [(tilex, tiley, zoom), ...] not yet cached, in parallel within
+        the rate limits of the tile source, progress(stats) is called every interval seconds
+        returns stats: total, cached, done, failed, rate (tiles/s), eta (s), elapsed (s)
+    """
+    layer = tilesource.getLayerName()
+    keys = list(dict.fromkeys(keys))
+    missing = []
+    for zoom in sorted(set([key[2] for key in keys])):
+        zkeys = [key for key in keys if key[2] == zoom]
+        cached = tilesource.cache.lookup(layer, zkeys)
+        missing.extend([key for key in zkeys if not(key in cached)])
+    stats = dict(total=len(missing), cached=len(keys)-len(missing), done=0, failed=0, rate=0.0, eta=None, elapsed=0.0)
+    request = TileRequest(requestID=None)
+    pending = set()
+    t0 = time.time()
+    last = t0
+    queue = iter(missing)
+    try:
+        while True:
+            # keep the download queue filled, but not with the whole plan
+            for key in queue:
+                pending.add(tilesource.submitDownload(*key, request=request, priority=PRIORITY_SEED))
+                if len(pending) >= max_pending:
+                    break
+            if not(pending):
+                break
+            (done, pending) = wait(pending, timeout=interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                stats["done"] += 1
+                if future.exception() or future.result() is None:
+                    stats["failed"] += 1
+            now = time.time()
+            stats["elapsed"] = now - t0
+            stats["rate"] = stats["done"] / stats["elapsed"] if stats["elapsed"] else 0.0
+            if stats["rate"]:
+                stats["eta"] = (stats["total"] - stats["done"]) / stats["rate"]
+            if progress and (now - last >= interval or not(pending)):
+                progress(stats)
+                last = now
+    finally:
+        # on interruption: drop the queued downloads, the next run resumes with the missing tiles
+        request.cancel()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="download the tiles of a region into the cache")
+    parser.add_argument("cachedir", help="tile cache directory")
+    parser.add_argument("--source", choices=sorted(SOURCES), default="osm", help="tile source, default: osm")
+    parser.add_argument("--url", default=None, help="url template with {x}, {y} and {z} instead of --source")
+    parser.add_argument("--layer", default="custom", help="cache layer of --url, default: custom")
+    parser.add_argument("--tile-size", type=int, default=None, help="size of the tile images, e.g. 512")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--bbox", nargs=4, type=float, metavar=("LON1", "LAT1", "LON2", "LAT2"))
+    region.add_argument("--polygon", help="GeoJSON file with a polygon")
+    parser.add_argument("--zoom", nargs=2, type=int, required=True, metavar=("MIN", "MAX"))
+    parser.add_argument("--delay", type=float, default=1, help="minimum interval between requests per host (s)")
+    parser.add_argument("--inflight", type=int, default=2, help="maximum concurrent requests per host")
+    parser.add_argument("--mbtiles", action="store_true", help="cache in MBTiles files instead of directories")
+    args = parser.parse_args(argv)
+    cache = None
+    if args.mbtiles:
+        from qtmaps.cache import MBTilesCache
+        cache = MBTilesCache(args.cachedir)
+    if args.url:
+        tilesource = UrlTileSource(args.layer, args.cachedir, args.url, download_delay=args.delay,
+                                   max_inflight=args.inflight, cache=cache, tile_size=args.tile_size)
+    else:
+        tilesource = SOURCES[args.source](args.source, args.cachedir, download_delay=args.delay,
+                                          max_inflight=args.inflight, cache=cache, tile_size=args.tile_size)
+    zooms = range(args.zoom[0], args.zoom[1]+1)
+    if args.bbox:
+        keys = planBBox(*args.bbox, zooms)
+    else:
+        keys = planPolygon(readPolygon(args.polygon), zooms)
+    print("%s: %d tiles in zoom levels %d-%d" % (tilesource.getLayerName(), len(keys), zooms[0], zooms[-1]))
+    try:
+        stats = seed(tilesource, keys, progress=printProgress)
+    except KeyboardInterrupt:
+        print("\ninterrupted, run again to resume")
+        sys.exit(1)
+    finally:
+        tilesource.cache.close()
+    print("\n%d cached before, %d downloaded, %d failed in %s" % (stats["cached"], stats["done"]-stats["failed"],
+                                                                stats["failed"], formatDuration(stats["elapsed"])))
+
+
+if __name__ == "__main__":
+    main()
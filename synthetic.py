@@ -0,0 +1,126 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+procedural tile source for load and soak tests, no network access
+
+tiles are rendered deterministically from (seed, zoom, x, y), latency, jitter and
+error rate simulate slow and flaky servers:
+
+    tilesource = SyntheticTileSource("synthetic", cachedir, latency=0.2, jitter=0.1, error_rate=0.05)
+    qtWmsMap("synthetic", tilesource)
+'''
+
+import random
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from qtmaps.cache import TileMeta
+from qtmaps.wms import TileSource, NOT_MODIFIED, now
+
+
+def encodePNG(image:np.ndarray, level=1) -> bytes:
+    """ RGB PNG of a (height, width, 3) uint8 array """
+    (height, width) = image.shape[:2]
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)    # filter byte 0 per row
+    rows[:,1:] = image.reshape(height, width * 3)
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows.tobytes(), level)) + \
+        chunk(b"IEND", b"")
+
+def renderTile(seed, tilex, tiley, zoom, size=256, noise=16) -> np.ndarray:
+    """ checkerboard in a color of the tile with a dark border, noise keeps the PNG from
+        compressing away so decoding has a realistic cost
+    """
+    key = zlib.crc32(struct.pack(">iiii", seed, zoom, tilex, tiley))
+    color = np.array([64 + (key >> shift) % 160 for shift in (0, 8, 16)], dtype=np.float32)
+    (yy, xx) = np.mgrid[0:size, 0:size]
+    cell = max(size // 8, 1)
+    checker = ((xx // cell + yy // cell) % 2).astype(np.float32)
+    image = np.empty((size, size, 3), dtype=np.float32)
+    image[:] = color
+    image *= (0.8 + 0.2 * checker)[:,:,None]
+    if noise:
+        image += np.random.default_rng(key).integers(-noise, noise+1, size=image.shape)
+    image[[0, -1],:] = color * 0.3
+    image[:,[0, -1]] = color * 0.3
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+class SyntheticTileSource(TileSource):
+    """ tiles rendered locally, seed selects the tile set (and the cache layer) """
+
+    SRC_NAME = "synthetic-{seed}"
+    TILE_URL = "synthetic://synthetic-{seed}/{z}/{x}/{y}.png"
+    MAX_AGE = None
+
+    def __init__(self, name, cachedir, seed=0, tile_size=256, latency=0.0, jitter=0.0, error_rate=0.0, noise=16,
+                 download_delay=0, max_inflight=8, **kwargs):
+        """ latency: seconds per tile, plus a uniformly distributed jitter of up to jitter seconds
+            error_rate: probability of a failed download (0..1)
+            download_delay, max_inflight: per source limits as with a http host,
+            applied by the TileDownloader or the fetcher before fetchTileData() runs
+        """
+        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=download_delay,
+                            max_inflight=max_inflight, tile_size=tile_size, **kwargs)
+        self.seed = seed
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = error_rate
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.src_name_args = dict(seed=seed)
+
+    def getTileUrl(self, tilex, tiley, zoom):
+        return self.TILE_URL.format(seed=self.seed, x=tilex, y=tiley, z=zoom)
+
+    def getETag(self, tilex, tiley, zoom):
+        return '"%s-%d-%d-%d"' % (self.getLayerName(), zoom, tilex, tiley)
+
+    def fetchTileData(self, tilex, tiley, zoom, meta:TileMeta=None):
+        """ renders the tile after the simulated latency, see TileSource.fetchTileData() """
+        start = time.perf_counter()
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.random.random() < self.errorRate:
+            self.metrics.count("download_errors")
+            return (None, None)
+        etag = self.getETag(tilex, tiley, zoom)
+        if meta and meta.etag == etag:
+            data = NOT_MODIFIED
+            self.metrics.count("not_modified")
+        else:
+            data = encodePNG(renderTile(self.seed, tilex, tiley, zoom, size=self.tileSize, noise=self.noise))
+            self.metrics.count("bytes_received", len(data))
+        self.metrics.observe("download_ms", (time.perf_counter() - start) * 1000)
+        self.metrics.count("downloads")
+        return (data, TileMeta(now(), etag, None))
+
+
+# test
+
+def test():
+    import sys
+    import tempfile
+    from PyQt5.Qt import QApplication
+    from qtmaps.qt import qtTwinWmsMap
+    app = QApplication(sys.argv)
+    cachedir = tempfile.mkdtemp(prefix="qtmaps-synthetic-")
+    tilesource1 = SyntheticTileSource("fast", cachedir, seed=1)
+    tilesource2 = SyntheticTileSource("flaky", cachedir, seed=2, latency=0.3, jitter=0.5, error_rate=0.1)
+    twin = qtTwinWmsMap(tilesource1, tilesource2, mapsize=(512, 512), align="horizontal", initial=(11.6, 52.1, 10))
+    twin.show()
+    app.exec_()
+
+if __name__ == "__main__":
+    test()
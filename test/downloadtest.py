@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+
+'''
+@created: 18.10.2026
+@author : Jens Götze
+@email  : jg_git@gmx.net
+@license: BSD
+
+scheduling of downloads with synthetic tiles, no network access
+'''
+import time
+import tempfile
+from threading import Lock
+
+from qtmaps.wms import TileRequest
+from qtmaps.aio import AsyncTileFetcher
+from qtmaps.synthetic import SyntheticTileSource
+from qtmaps.seed import seed
+
+
+class CountingTileSource(SyntheticTileSource):
+    """ records the peak number of concurrent fetches """
+    
+    def __init__(self, *args, **kwargs):
+        SyntheticTileSource.__init__(self, *args, **kwargs)
+        self.lock = Lock()
+        self.running = 0
+        self.peak = 0
+        
+    def fetchTileData(self, tilex, tiley, zoom, meta=None):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            return SyntheticTileSource.fetchTileData(self, tilex, tiley, zoom, meta)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def waitFor(condition, timeout=10):
+    end = time.time() + timeout
+    while not(condition()):
+        assert time.time() < end, "timeout"
+        time.sleep(0.005)
+
+
+# test
+
+def test1():
+    """ tiles of a cancelled request still waiting for a slot of their host are not fetched """
+    for fetcher in (None, AsyncTileFetcher()):
+        tilesource = SyntheticTileSource("cancel", tempfile.mkdtemp(), latency=0.05, max_inflight=2, fetcher=fetcher)
+        request = TileRequest(1)
+        futures = [tilesource.submitDownload(x, 0, 6, request=request) for x in range(36)]
+        waitFor(lambda: tilesource.getMetrics()["counters"].get("downloads", 0) >= 4)
+        request.cancel()
+        waitFor(lambda: all([f.done() for f in futures]))
+        downloads = tilesource.getMetrics()["counters"]["downloads"]
+        print("fetcher" if fetcher else "downloader", "downloads of 36 cancelled tiles:", downloads)
+        assert downloads <= 4 + tilesource.maxInflight
+        if fetcher:
+            fetcher.close()
+
+
+def test2():
+    """ the seeder runs max_inflight requests per host """
+    for max_inflight in (2, 4):
+        # a seed per run, the limiter of a host is created with the limits of its first source
+        tilesource = CountingTileSource("seed", tempfile.mkdtemp(), seed=max_inflight, latency=0.05,
+                                        max_inflight=max_inflight)
+        stats = seed(tilesource, [(x, y, 6) for x in range(8) for y in range(4)])
+        print("seed max_inflight", max_inflight, "peak", tilesource.peak, "done", stats["done"])
+        assert tilesource.peak == max_inflight and stats["done"] == 32
+
+
+def test3():
+    """ a new tile set is not evicted by adding it, also beyond max_tiles """
+    tilesource = SyntheticTileSource("evict", tempfile.mkdtemp(), max_tiles=20)
+    tilesource.loadTiles(0, 0, 4, 300, 300, 300, 300)
+    tilesource.loadTiles(10, 10, 4, 300, 300, 300, 300)
+    tilesetid = tilesource.addTileSet(tilesource.planTiles(20, 20, 4, 300, 300, 300, 300))
+    print("tile sets", len(tilesource.tileSets), "evicted", tilesource.tileSets.evictedCount)
+    assert tilesetid in tilesource.tileSets and tilesource.getActiveTileSet().lon == 10
+
+
+def test4():
+    """ a revalidation is not merged into a plain download of the same tile in flight """
+    for fetcher in (None, AsyncTileFetcher()):
+        tilesource = SyntheticTileSource("revalidate", tempfile.mkdtemp(), latency=0.1, fetcher=fetcher)
+        tilesource.submitDownload(0, 0, 4).result()
+        futures = [tilesource.submitDownload(0, 0, 4), tilesource.submitRevalidation(0, 0, 4)]
+        waitFor(lambda: all([f.done() for f in futures]))
+        counters = tilesource.getMetrics()["counters"]
+        print("fetcher" if fetcher else "downloader", "downloads", counters["downloads"],
+              "not modified", counters.get("not_modified", 0))
+        assert counters["downloads"] == 3 and counters.get("not_modified") == 1
+        if fetcher:
+            fetcher.close()
+
+
+def test():
+    test1()
+    test2()
+    test3()
+    test4()
+
+
+if __name__ == "__main__":
+    test()
@@ -14,25 +14,271 @@ https://wiki.earthdata.nasa.gov/display/GIBS/Map+Library+Usage#expand-GDALBasics
 https://wiki.earthdata.nasa.gov/display/GIBS/GIBS+Available+Imagery+Products#expand-CorrectedReflectance16Products
 '''
 
-from collections import namedtuple
-from threading import Thread
+from collections import namedtuple, OrderedDict
+from threading import Thread, Lock, Condition, local
+from concurrent.futures import Future, as_completed
+from itertools import count
 
 import smopy
+import heapq
 import time
 import os
-from urllib.request import urlretrieve
-from urllib.error import URLError, HTTPError
+import logging
+from urllib.parse import urlsplit
+from http.client import HTTPException
 import numpy as np
 import subprocess
 
+from qtmaps.httppool import getDefaultPool, HTTPResponse
+from qtmaps.cache import DirectoryTileCache, TileMeta
+from qtmaps.projection import Projection, get_projection, lonlat_to_tile, tile_to_lonlat
+from qtmaps.metrics import Metrics
+
+log = logging.getLogger(__name__)
+
 
 ###
 
+# result of a conditional request for an unchanged tile
+NOT_MODIFIED = object()
+
+# download priorities, lower runs first
+PRIORITY_VIEW = 0
+PRIORITY_REVALIDATE = 5
+PRIORITY_PREFETCH = 10
+PRIORITY_SEED = 20
+
+# slots and tokens of a host left to downloads of higher priority, by priority
+PRIORITY_RESERVE = {PRIORITY_PREFETCH: 1}
+
 def now():
     return time.time()
 
+
+class HostLimiter():
+    """ limits the request rate and the number of concurrent requests to one host
+        the rate is a token bucket: up to burst requests start at once, then rate per second
+    """
+    
+    def __init__(self, rate=None, max_inflight=2, burst=4, on_release=None):
+        """ on_release() is called without locks held whenever a slot becomes free """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.maxInflight = max_inflight
+        self.onRelease = on_release
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.inflight = 0
+        self.cond = Condition()
+        self.local = local()
+        
+    def tryAcquire(self, reserve=0):
+        """ takes a slot and a token without blocking, returns 0 on success, otherwise the seconds
+            until the next token or None while all slots are taken
+            reserve: number of slots and tokens left for other requests (as far as the limits allow)
+        """
+        with self.cond:
+            if self.inflight >= self.maxInflight - min(reserve, self.maxInflight - 1):
+                return None
+            if self.rate:
+                current_time = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (current_time - self.updated) * self.rate)
+                self.updated = current_time
+                needed = 1 + min(reserve, self.burst - 1)
+                if self.tokens < needed:
+                    return (needed - self.tokens) / self.rate
+                self.tokens -= 1
+            self.inflight += 1
+            return 0
+        
+    def own(self):
+        """ the calling thread holds the slot taken by tryAcquire(), until release()
+            nested acquire() calls in the thread do not take another slot
+        """
+        self.local.depth = 1
+        
+    def acquire(self):
+        depth = getattr(self.local, "depth", 0)
+        if depth:
+            self.local.depth = depth + 1
+            return
+        with self.cond:
+            while True:
+                wait = self.tryAcquire()
+                if wait == 0:
+                    break
+                self.cond.wait(wait)
+        self.own()
+            
+    def release(self):
+        self.local.depth -= 1
+        if self.local.depth:
+            return
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+        if self.onRelease:
+            self.onRelease()
+        
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.release()
+        
+        
+class TileRequest():
+    """ handle of a background tile request, tiles not yet fetched are dropped after cancel() """
+    
+    def __init__(self, requestID):
+        self.requestID = requestID
+        self.cancelled = False
+        
+    def cancel(self):
+        self.cancelled = True
+        
+        
+class InflightTile():
+    def __init__(self, request, priority):
+        self.requests = [request]
+        self.priority = priority
+        self.started = False
+        self.future = Future()
+        
+    def isCancelled(self) -> bool:
+        """ True if every request waiting for the tile has been cancelled """
+        return all([not(r is None) and r.cancelled for r in self.requests])
+        
+
+class TileDownloader():
+    """ bounded pool of download threads, shared by all tile sources 
+        jobs wait in one queue per host and run in order of priority (lowest first), 
+        then in order of submission, a worker only takes a job whose host has a free slot
+        in its HostLimiter, so a slow host does not hold up the others,
+        prefetch jobs leave one slot and one token of their host to view jobs (PRIORITY_RESERVE),
+        concurrent requests for the same tile wait for one download
+    """
+    
+    def __init__(self, max_workers=8):
+        self.maxWorkers = max_workers
+        self.ready = dict()         # HostLimiter (None: not limited) -> heap of (priority, n, job, entry)
+        self.counter = count()
+        self.workers = []
+        self.limiters = dict()
+        self.inflight = dict()
+        self.lock = Lock()
+        self.wakeup = Condition(self.lock)
+        
+    def getLimiter(self, host, rate=None, max_inflight=2, burst=4) -> HostLimiter:
+        """ returns the limiter of host, created with rate, max_inflight and burst on first use """
+        with self.lock:
+            if not(host in self.limiters):
+                self.limiters[host] = HostLimiter(rate=rate, max_inflight=max_inflight, burst=burst,
+                                                  on_release=self.notify)
+            return self.limiters[host]
+        
+    def notify(self):
+        with self.lock:
+            self.wakeup.notify_all()
+        
+    def _put(self, priority, job, limiter:HostLimiter=None, entry=None):
+        with self.lock:
+            heapq.heappush(self.ready.setdefault(limiter, []), (priority, next(self.counter), job, entry))
+            if len(self.workers) < self.maxWorkers:
+                worker = Thread(target=self._work, name="tiledownload-%d" % len(self.workers))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self.wakeup.notify()
+            
+    def _next(self):
+        """ waits for the first job of a host with a free slot, returns (job, limiter) """
+        with self.lock:
+            while True:
+                delay = None
+                for limiter in sorted(self.ready, key=lambda limiter: self.ready[limiter][0][:2]):
+                    queue = self.ready[limiter]
+                    (priority, n, job, entry) = queue[0]
+                    skipped = not(entry is None) and (entry.started or entry.isCancelled())
+                    if not(limiter is None or skipped):
+                        wait = limiter.tryAcquire(reserve=PRIORITY_RESERVE.get(priority, 0))
+                        if wait is None:
+                            continue
+                        if wait > 0:
+                            delay = wait if delay is None else min(delay, wait)
+                            continue
+                    heapq.heappop(queue)
+                    if not(queue):
+                        self.ready.pop(limiter)
+                    # jobs that do not download run without a slot
+                    return (job, None if skipped else limiter)
+                self.wakeup.wait(delay)
+        
+    def _work(self):
+        while True:
+            (job, limiter) = self._next()
+            if limiter is None:
+                job()
+                continue
+            limiter.own()
+            try:
+                job()
+            finally:
+                limiter.release()
+    
+    def submitTile(self, key, func, args, request:TileRequest=None, priority=PRIORITY_VIEW,
+                   limiter:HostLimiter=None) -> Future:
+        """ returns a Future of func(*args), shared by all requests for the same key 
+            the download is skipped (result None) if all its requests are cancelled before it starts,
+            a waiting download is moved up if a request with higher priority joins,
+            func runs holding a slot of limiter (nested acquire() calls of it do not block)
+        """
+        with self.lock:
+            entry = self.inflight.get(key)
+            if entry is None:
+                entry = InflightTile(request, priority)
+                self.inflight[key] = entry
+            else:
+                entry.requests.append(request)
+                if entry.started or priority >= entry.priority:
+                    return entry.future
+                entry.priority = priority
+        self._put(priority, lambda: self._runTile(key, entry, func, args), limiter, entry)
+        return entry.future
+        
+    def _runTile(self, key, entry, func, args):
+        with self.lock:
+            if entry.started:
+                # already run from a queue slot of higher priority
+                return
+            entry.started = True
+            if entry.isCancelled():
+                self.inflight.pop(key, None)
+                entry.future.set_result(None)
+                return
+        try:
+            result = func(*args)
+        except BaseException as e:
+            entry.future.set_exception(e)
+        else:
+            entry.future.set_result(result)
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+    
+    
+_defaultDownloader = None
+
+def getDefaultDownloader() -> TileDownloader:
+    global _defaultDownloader
+    if _defaultDownloader is None:
+        _defaultDownloader = TileDownloader()
+    return _defaultDownloader
+
+
 class Tile():
-    def __init__(self):
+    def __init__(self, width=256, height=256):
         self.path = ""
         self.xtile = 0
         self.ytile = 0
@@ -41,8 +287,8 @@ class Tile():
         self.sceneY = 0
         self.mapX = 0
         self.mapY = 0
-        self.width = 256
-        self.height = 256
+        self.width = width      # in scene pixels
+        self.height = height
         
     def sceneBBox(self):
         return (self.sceneX, self.sceneY, self.sceneX+self.width, self.sceneY+self.height)
@@ -53,6 +299,89 @@ class Tile():
  
 TileSet = namedtuple("TileSet", ["lon","lat","zoom","w1","w2","h1","h2","tiles","tilesBBox","coordsBBox","upperLeftTile"])
 
+class TileSetEvictedError(LookupError):
+    """ the requested tile set has been evicted from the TileSetStore """
+    
+
+class TileSetStore():
+    """ tile sets by stable, increasing ids 
+        the least recently used sets are evicted if there are more than max_count sets
+        or more than max_tiles tiles (as a measure of memory), pinned sets are never evicted
+    """
+    
+    def __init__(self, max_count=32, max_tiles=None):
+        self.maxCount = max_count
+        self.maxTiles = max_tiles
+        self.tileSets = OrderedDict()
+        self.pins = dict()
+        self.nTiles = 0
+        self.lastID = -1
+        self.evictedCount = 0
+        self.lock = Lock()
+        
+    @staticmethod
+    def countTiles(tileset:TileSet) -> int:
+        return sum([len(row) for row in tileset.tiles])
+        
+    def add(self, tileset:TileSet, pin=False) -> int:
+        with self.lock:
+            self.lastID += 1
+            tilesetid = self.lastID
+            self.tileSets[tilesetid] = tileset
+            self.nTiles += self.countTiles(tileset)
+            if pin:
+                self.pins[tilesetid] = 1
+            self._evict(keep=tilesetid)
+        return tilesetid
+    
+    def get(self, tilesetid:int) -> TileSet:
+        """ raises TileSetEvictedError for evicted and KeyError for unknown ids """
+        with self.lock:
+            if tilesetid in self.tileSets:
+                self.tileSets.move_to_end(tilesetid)
+                return self.tileSets[tilesetid]
+        if self.isEvicted(tilesetid):
+            raise TileSetEvictedError("tile set %r has been evicted" % tilesetid)
+        raise KeyError(tilesetid)
+    
+    def isEvicted(self, tilesetid:int) -> bool:
+        with self.lock:
+            return isinstance(tilesetid, int) and (0 <= tilesetid <= self.lastID) and not(tilesetid in self.tileSets)
+    
+    def pin(self, tilesetid:int):
+        """ protects the tile set from eviction until unpin() is called """
+        with self.lock:
+            if tilesetid in self.tileSets:
+                self.pins[tilesetid] = self.pins.get(tilesetid, 0) + 1
+    
+    def unpin(self, tilesetid:int):
+        with self.lock:
+            if tilesetid in self.pins:
+                self.pins[tilesetid] -= 1
+                if self.pins[tilesetid] <= 0:
+                    self.pins.pop(tilesetid)
+            self._evict()
+        
+    def _evict(self, keep=None):
+        """ removes least recently used, unpinned sets other than keep (lock must be held) """
+        for tilesetid in list(self.tileSets):
+            too_many = self.maxCount and len(self.tileSets) > self.maxCount
+            too_large = self.maxTiles and self.nTiles > self.maxTiles
+            if not(too_many or too_large):
+                break
+            if tilesetid in self.pins or tilesetid == keep:
+                continue
+            tileset = self.tileSets.pop(tilesetid)
+            self.nTiles -= self.countTiles(tileset)
+            self.evictedCount += 1
+            
+    def __len__(self):
+        return len(self.tileSets)
+    
+    def __contains__(self, tilesetid):
+        return tilesetid in self.tileSets
+
+
 class ViewRequest():
     def __init__(self, coord, zoom, wait, requestID, tileSetID, created, displayed):
         self.coord = coord
@@ -62,6 +391,7 @@ class ViewRequest():
         self.tileSetID  = tileSetID
         self.created    = created
         self.displayed  = displayed
+        self.complete   = False
         self.timeout    = 15
     def __str__(self):
         args = (self.coord, self.zoom, self.wait, self.requestID, self.tileSetID, self.displayed)
@@ -73,96 +403,292 @@ class TileSource():
     
     SRC_NAME = "osm_a"
     TILE_URL = "http://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+    LAYER = None            # cache layer, sources serving the same tiles share it, None: SRC_NAME
+    MAX_TILESETS = 32
+    MAX_TILES = None        # tiles of all stored tile sets (as a measure of memory), None: no limit
+    MAX_AGE = 7*24*3600     # cached tiles older than MAX_AGE seconds are revalidated, None: never
+    TILE_SIZE = 256         # width and height of the tile images in pixels
+    PIXEL_RATIO = None      # image pixels per scene pixel, 2 for @2x tiles on HiDPI screens, None: see setDevicePixelRatio()
     
-    def __init__(self, name, cachedir, download_delay=1):
+    def __init__(self, name, cachedir, download_delay=1, max_inflight=2, downloader=None, http_pool=None, cache=None,
+                 fetcher=None, tile_size=None, pixel_ratio=None, download_burst=4, max_tiles=None):
+        """ download_delay: average interval between two requests to the same host (seconds)
+            download_burst: number of requests to the same host that may start at once,
+                            before download_delay applies
+            max_inflight: maximum number of concurrent requests to the same host
+            downloader: TileDownloader, defaults to the shared one 
+            http_pool: HTTPConnectionPool, defaults to the shared one
+            cache: TileCache, defaults to a DirectoryTileCache in cachedir
+            fetcher: qtmaps.aio.AsyncTileFetcher, downloads and background requests run
+                     in its event loop instead of the downloader and request threads
+            tile_size: size of the tile images, defaults to TILE_SIZE
+            pixel_ratio: defaults to PIXEL_RATIO, a tile covers tile_size/pixel_ratio scene pixels,
+                         e.g. 512px tiles with pixel_ratio 2 are drawn sharp on HiDPI screens
+                         at the zoom levels of 256px tiles, if neither is given the view derives it
+                         from the screen, see setDevicePixelRatio()
+            max_tiles: defaults to MAX_TILES, least recently used tile sets are evicted beyond it
+        """
         self.name = name
         self.cachedir = cachedir
+        self.cache = cache or DirectoryTileCache(cachedir)
         self.download_delay = download_delay
+        self.downloadBurst = download_burst
+        self.maxInflight = max_inflight
+        self.downloader = downloader or getDefaultDownloader()
+        self.httpPool = http_pool or getDefaultPool()
+        self.fetcher = fetcher
+        self.metrics = Metrics()
         self.src_name_args = None
-        self.last_download = time.time()
-        self.tileSets = []
+        self.tileSets = TileSetStore(max_count=self.MAX_TILESETS, max_tiles=max_tiles or self.MAX_TILES)
         self.tileSetID = None 
-        self.tileWidth = 256
-        self.tileHeight = 256
+        self.tileSize = tile_size or self.TILE_SIZE
+        self.autoPixelRatio = not(pixel_ratio or self.PIXEL_RATIO)
+        self.setPixelRatio(pixel_ratio or self.PIXEL_RATIO or 1)
         self.requestsCount = 0
+        self.requests = dict()
         
     def getName(self):
         return self.name
     
+    def setPixelRatio(self, pixel_ratio):
+        """ image pixels per scene pixel, set before the first tile set is planned """
+        self.pixelRatio = pixel_ratio
+        # in scene pixels
+        self.tileWidth = int(round(self.tileSize / self.pixelRatio))
+        self.tileHeight = self.tileWidth
+        
+    def setDevicePixelRatio(self, device_ratio):
+        """ adapts the pixel ratio to a screen with device_ratio (QWidget.devicePixelRatioF()),
+            unless it was given: tiles larger than 256px are drawn with up to device_ratio image pixels
+            per scene pixel, so HiDPI screens get sharp tiles without fetching the next zoom level,
+            256px tiles keep pixel ratio 1
+        """
+        if self.autoPixelRatio:
+            self.setPixelRatio(max(1, min(device_ratio, self.tileSize / 256)))
+    
     def getTileUrl(self, tilex, tiley, zoom):
         return self.TILE_URL.format(x=tilex, y=tiley, z=zoom)
     
-    def getTilePath(self, tilex, tiley, zoom):
+    def getSourceName(self):
         if self.src_name_args:
-            src_name = self.SRC_NAME.format(**self.src_name_args)
+            return self.SRC_NAME.format(**self.src_name_args)
         else:
-            src_name = self.SRC_NAME
-        tile_dir = os.path.join(self.cachedir, src_name, str(zoom), str(tilex))
+            return self.SRC_NAME
+        
+    def getLayerName(self):
+        """ identity of the tiles, keys the cache and the de-duplication of downloads,
+            tile sizes other than 256 are cached in their own layer (e.g. osm@512)
+        """
+        layer = self.LAYER or self.SRC_NAME
+        if self.src_name_args:
+            layer = layer.format(**self.src_name_args)
+        if self.tileSize != 256:
+            layer = "%s@%d" % (layer, self.tileSize)
+        return layer
+    
+    def getTilePath(self, tilex, tiley, zoom):
+        """ path of the tile in the directory cache layout """
+        layer = self.getLayerName()
+        tile_dir = os.path.join(self.cachedir, layer, str(zoom), str(tilex))
         tile_fn = str(tiley)+".png"
         tile_path = os.path.join(tile_dir, tile_fn)
         return (tile_dir, tile_fn, tile_path)
     
-    def downloadTile(self, tilex, tiley, zoom):
-        print("downloading tile (x=%r, y=%r, z=%r) ..." % (tilex, tiley, zoom))
-        (tile_dir, tile_fn, tile_path) = self.getTilePath(tilex, tiley, zoom)
+    def getRequestHeaders(self, meta:TileMeta=None) -> dict:
+        """ with the meta of a cached tile the request is conditional """
+        headers = dict()
+        if meta and meta.etag:
+            headers["If-None-Match"] = meta.etag
+        if meta and meta.lastModified:
+            headers["If-Modified-Since"] = meta.lastModified
+        return headers
+    
+    def fetchTileData(self, tilex, tiley, zoom, meta:TileMeta=None):
+        """ downloads the tile, returns (data, meta), data is None on errors
+            with the meta of a cached tile the request is conditional, 
+            data is NOT_MODIFIED if the cached tile is still valid
+        """
         url = self.getTileUrl(tilex, tiley, zoom)
-        if not(os.path.exists(tile_dir)):
-            os.makedirs(tile_dir)
-        # wait if necessary
-        current_time = time.time()
-        time_left = current_time - self.last_download
-        if time_left < self.download_delay:
-            time.sleep(self.download_delay - time_left) 
-        #
         try:
-            print("... from %r" % url)
-            urlretrieve(url, tile_path)
-            ret = tile_path
-        except (URLError, HTTPError) as e:
-            print(e)
-            #print("error code:", e.code)
-            #print("error reason:", e.reason)
-            ret = None
-        self.last_download = time.time()
-        return ret
+            with self.getHostLimiter(url):
+                log.debug("GET %s", url)
+                start = time.perf_counter()
+                response = self.httpPool.get(url, headers=self.getRequestHeaders(meta))
+        except (OSError, HTTPException) as e:
+            log.warning("download of %s failed: %s", url, e)
+            self.metrics.count("download_errors")
+            return (None, None)
+        self.recordResponse(response, time.perf_counter() - start)
+        return self.parseResponse(url, response, meta)
+    
+    def recordResponse(self, response:HTTPResponse, seconds):
+        """ counts a tile response in the metrics """
+        self.metrics.observe("download_ms", seconds * 1000)
+        self.metrics.count("downloads")
+        self.metrics.count("bytes_received", len(response.data))
+        if response.status == 304:
+            self.metrics.count("not_modified")
+    
+    def parseResponse(self, url, response:HTTPResponse, meta:TileMeta=None):
+        """ returns (data, meta) of a tile response, see fetchTileData() """
+        if response.status == 304 and meta:
+            etag = response.headers.get("ETag") or meta.etag
+            lastModified = response.headers.get("Last-Modified") or meta.lastModified
+            return (NOT_MODIFIED, TileMeta(now(), etag, lastModified))
+        if response.status != 200:
+            log.warning("HTTP error %r: %s", response.status, url)
+            self.metrics.count("http_errors")
+            return (None, None)
+        meta = TileMeta(now(), response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return (response.data, meta)
+    
+    def storeTile(self, tilex, tiley, zoom, data, meta:TileMeta):
+        """ writes the result of fetchTileData() to the cache, returns the location or None on errors """
+        if data is None:
+            return None
+        layer = self.getLayerName()
+        if data is NOT_MODIFIED:
+            self.cache.writeMeta(layer, tilex, tiley, zoom, meta)
+        else:
+            self.cache.write(layer, tilex, tiley, zoom, data, meta)
+        return self.cache.location(layer, tilex, tiley, zoom)
+    
+    def downloadTile(self, tilex, tiley, zoom):
+        """ downloads the tile into the cache, returns its location or None """
+        log.debug("downloading tile (x=%r, y=%r, z=%r)", tilex, tiley, zoom)
+        (data, meta) = self.fetchTileData(tilex, tiley, zoom)
+        return self.storeTile(tilex, tiley, zoom, data, meta)
+    
+    def revalidateTile(self, tilex, tiley, zoom):
+        """ conditional download of a cached tile, returns its location or None on errors """
+        meta = self.cache.readMeta(self.getLayerName(), tilex, tiley, zoom)
+        (data, meta) = self.fetchTileData(tilex, tiley, zoom, meta=meta)
+        return self.storeTile(tilex, tiley, zoom, data, meta)
+    
+    def submitRevalidation(self, tilex, tiley, zoom):
+        if self.fetcher:
+            return self.fetcher.submitTile(self, tilex, tiley, zoom, priority=PRIORITY_REVALIDATE, revalidate=True)
+        # the key of AsyncTileFetcher.submitTile(), a revalidation is not merged into a plain download
+        key = (self.getLayerName(), zoom, tilex, tiley, True)
+        return self.downloader.submitTile(key, self.revalidateTile, (tilex, tiley, zoom), priority=PRIORITY_REVALIDATE,
+                                          limiter=self.getTileLimiter(tilex, tiley, zoom))
+    
+    def readTile(self, tilex, tiley, zoom) -> bytes:
+        """ returns the encoded tile from the cache or None """
+        return self.cache.read(self.getLayerName(), tilex, tiley, zoom)
+    
+    def getHostLimiter(self, url) -> HostLimiter:
+        rate = 1/self.download_delay if self.download_delay else None
+        host = urlsplit(url).hostname
+        return self.downloader.getLimiter(host, rate=rate, max_inflight=self.maxInflight, burst=self.downloadBurst)
+    
+    def getTileLimiter(self, tilex, tiley, zoom) -> HostLimiter:
+        """ the limiter of the host serving the tile, the downloader takes its slot before the job starts """
+        return self.getHostLimiter(self.getTileUrl(tilex, tiley, zoom))
     
     def provideTile(self, tilex, tiley, zoom):
         #print("provideTile(tilex=%r, tiley=%r, zoom=%r)" % (tilex, tiley, zoom))
-        (tile_dir, tile_fn, tile_path) = self.getTilePath(tilex, tiley, zoom)
-        if not(os.path.exists(tile_path)):
+        layer = self.getLayerName()
+        if not(self.cache.has(layer, tilex, tiley, zoom)):
             ret = self.downloadTile(tilex, tiley, zoom)
         else:
-            ret = tile_path
+            ret = self.cache.location(layer, tilex, tiley, zoom)
         return ret
     
+    def submitDownload(self, tilex, tiley, zoom, request:TileRequest=None, priority=PRIORITY_VIEW):
+        """ returns a Future of downloadTile(), concurrent downloads of the same tile are merged """
+        if self.fetcher:
+            return self.fetcher.submitTile(self, tilex, tiley, zoom, request=request, priority=priority)
+        key = (self.getLayerName(), zoom, tilex, tiley, False)
+        return self.downloader.submitTile(key, self.downloadTile, (tilex, tiley, zoom), request, priority,
+                                          limiter=self.getTileLimiter(tilex, tiley, zoom))
+    
+    def provideTiles(self, tiles, tileCallback=None, request:TileRequest=None):
+        """ sets the path of all tiles, missing tiles are downloaded in parallel 
+            tileCallback(tile) is executed for every tile as soon as it is available, 
+            cached tiles first 
+            stops when request is cancelled, tiles not yet downloaded are dropped,
+            the path of a tile whose download or caching failed is None
+        """
+        layer = self.getLayerName()
+        cached = self.cache.lookup(layer, [(tile.xtile, tile.ytile, tile.zoom) for tile in tiles])
+        self.recordLookup(len(cached), len(tiles))
+        if self.MAX_AGE and cached:
+            # stale tiles are delivered from the cache and revalidated in the background
+            for key in self.cache.stale(layer, cached, self.MAX_AGE):
+                self.submitRevalidation(*key)
+        futures = dict()
+        for tile in tiles:
+            if (tile.xtile, tile.ytile, tile.zoom) in cached:
+                tile.path = self.cache.location(layer, tile.xtile, tile.ytile, tile.zoom)
+                if tileCallback:
+                    tileCallback(tile)
+            else:
+                future = self.submitDownload(tile.xtile, tile.ytile, tile.zoom, request)
+                futures[future] = tile
+        for future in as_completed(futures):
+            if request and request.cancelled:
+                break
+            tile = futures[future]
+            if future.exception():
+                log.warning("tile (x=%r, y=%r, z=%r) failed: %r", tile.xtile, tile.ytile, tile.zoom, future.exception())
+                tile.path = None
+            else:
+                tile.path = future.result()
+            if tileCallback:
+                tileCallback(tile)
+    
+    def recordLookup(self, hits, n):
+        self.metrics.count("cache_hits", hits)
+        self.metrics.count("cache_misses", n - hits)
+        
+    def getMetrics(self) -> dict:
+        """ snapshot of the metrics (see qtmaps.metrics) and the counters of the HTTP connections,
+            which may be shared with other tile sources
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot["http"] = self.fetcher.client.getStats() if self.fetcher else self.httpPool.getStats()
+        return snapshot
+    
     def getTileByCoords(self, lon, lat, zoom):
-        (x, y) = smopy.deg2num(lat, lon, zoom, do_round=True)
-        return self.provideTile(x, y, zoom)
+        (xtilef, ytilef) = lonlat_to_tile(lon, lat, zoom)
+        return self.provideTile(int(xtilef), int(ytilef), zoom)
     
     def getTilesBBox(self, lon, lat, zoom, w1, w2, h1, h2):
         pass
 
-    def addTileSet(self, tileset:TileSet) -> int:
-        self.tileSets.append(tileset)
-        return len(self.tileSets)-1
+    def addTileSet(self, tileset:TileSet, pin=False) -> int:
+        """ pin: protect the tile set from eviction until unpinTileSet() is called """
+        return self.tileSets.add(tileset, pin=pin)
+    
+    def pinTileSet(self, tilesetid:int):
+        self.tileSets.pin(tilesetid)
+        
+    def unpinTileSet(self, tilesetid:int):
+        self.tileSets.unpin(tilesetid)
     
     def setActiveTileSet(self, tilesetid:int):
-        assert tilesetid in range(len(self.tileSets))
+        """ raises TileSetEvictedError if the tile set has been evicted """
+        self.tileSets.get(tilesetid)
+        # the active tile set is never evicted
+        self.tileSets.pin(tilesetid)
+        if not(self.tileSetID is None):
+            self.tileSets.unpin(self.tileSetID)
         self.tileSetID = tilesetid
         
     def getActiveTileSet(self) -> TileSet:
-        return self.tileSets[self.tileSetID]
+        return self.tileSets.get(self.tileSetID)
     
-    def _loadTiles(self, lon, lat, zoom, w1, w2, h1, h2):
-        """ returns TilesSet """
+    def planTiles(self, lon, lat, zoom, w1, w2, h1, h2):
+        """ returns TileSet, the tiles are not provided yet (path is None) """
         # tile width and height
-        tw = 256
-        th = 256
+        tw = self.tileWidth
+        th = self.tileHeight
         # view port width and height
         vw = w1+w2
         vh = h1+h2
         # base tile (float, int, relative from upper-left corner)
-        (btxf, btyf) = smopy.deg2num(latitude=lat, longitude=lon, zoom=zoom, do_round=False)
+        (btxf, btyf) = get_projection(zoom).toTile(lon, lat)
         btx, bty = int(btxf), int(btyf) 
         btxr, btyr = np.modf(btxf)[0], np.modf(btyf)[0]
         # number of extra tiles in directions N, E, S, W
@@ -175,27 +701,30 @@ class TileSource():
         tilesBBox = (btx-nw, bty-nn, btx+ne, bty+ns)
         tilesBBox = tuple([int(x) for x in smopy.correct_box(box=tilesBBox, z=zoom)])
         # coords bbox
-        (lat1, lon1) = smopy.num2deg(xtile=tilesBBox[0], ytile=tilesBBox[1], zoom=zoom)
-        (lat2, lon2) = smopy.num2deg(xtile=tilesBBox[2]+1, ytile=tilesBBox[3]+1, zoom=zoom)
+        (lon1, lat1) = tile_to_lonlat(tilesBBox[0], tilesBBox[1], zoom)
+        (lon2, lat2) = tile_to_lonlat(tilesBBox[2]+1, tilesBBox[3]+1, zoom)
         coordsBBox = (lon1, lat1, lon2, lat2)
-        # provide tiles
+        # coords of all tile columns and rows at once
+        (tlons, tlats) = tile_to_lonlat(np.arange(tilesBBox[0], tilesBBox[2]+1),
+                                        np.arange(tilesBBox[1], tilesBBox[3]+1), zoom)
+        # plan tiles
         tiles = []
         ix = 0
         for xtile in range(tilesBBox[0], tilesBBox[2]+1):
             tilesrow = []
             iy = 0
             for ytile in range(tilesBBox[1], tilesBBox[3]+1):
-                lat, lon = smopy.num2deg(xtile, ytile, zoom)
+                tlon, tlat = float(tlons[ix]), float(tlats[iy])
                 #
-                tile = Tile()
-                tile.path   = self.provideTile(xtile, ytile, zoom)
+                tile = Tile(tw, th)
+                tile.path   = None
                 tile.xtile  = xtile
                 tile.ytile  = ytile
                 tile.zoom   = zoom
                 tile.sceneX = ix * tw
                 tile.sceneY = iy * th
-                tile.mapX   = lon
-                tile.mapY   = lat
+                tile.mapX   = tlon
+                tile.mapY   = tlat
                 #  
                 tilesrow.append(tile)
                 iy += 1
@@ -205,60 +734,261 @@ class TileSource():
         tileSet = TileSet(lon, lat, zoom, w1, w2, h1, h2, tiles, tilesBBox, coordsBBox, upperLeftTile)
         return tileSet
     
+    @staticmethod
+    def iterTiles(tileset:TileSet):
+        for tilesrow in tileset.tiles:
+            for tile in tilesrow:
+                yield tile
+    
+    def _loadTiles(self, lon, lat, zoom, w1, w2, h1, h2):
+        """ returns TilesSet """
+        tileSet = self.planTiles(lon, lat, zoom, w1, w2, h1, h2)
+        self.provideTiles(list(self.iterTiles(tileSet)))
+        return tileSet
+    
     def createRequestID(self):
         self.requestsCount += 1
         return self.requestsCount
     
-    def _requestTilesRun(self, requestID, args, callback):
-        tileset = self._loadTiles(*args)
-        tileSetID = self.addTileSet(tileset)
-        callback(requestID, tileSetID)
+    def planTileRange(self, tileset:TileSet, x1, y1, x2, y2, skip=()) -> list:
+        """ returns the tiles x1..x2, y1..y2 of the zoom level of tileset, clipped to the world,
+            placed in the scene of tileset (relative to its upper left tile), not provided yet
+            skip: keys (zoom, xtile, ytile) of tiles not to plan, e.g. the ones already displayed
+        """
+        zoom = tileset.zoom
+        n = 2**zoom
+        upperLeftTile = tileset.upperLeftTile
+        keys = [(xtile, ytile) for xtile in range(max(x1, 0), min(x2, n-1)+1) 
+                for ytile in range(max(y1, 0), min(y2, n-1)+1) if not((zoom, xtile, ytile) in skip)]
+        if not(keys):
+            return []
+        (lons, lats) = tile_to_lonlat(*np.array(keys).T, zoom)
+        tiles = []
+        for ((xtile, ytile), lon, lat) in zip(keys, lons.tolist(), lats.tolist()):
+            tile = Tile(self.tileWidth, self.tileHeight)
+            tile.path   = None
+            tile.xtile  = xtile
+            tile.ytile  = ytile
+            tile.zoom   = zoom
+            tile.sceneX = (xtile - upperLeftTile.xtile) * self.tileWidth
+            tile.sceneY = (ytile - upperLeftTile.ytile) * self.tileHeight
+            (tile.mapX, tile.mapY) = (lon, lat)
+            tiles.append(tile)
+        return tiles
     
-    def requestTiles(self, lon, lat, zoom, w1, w2, h1, h2, callback):
+    def _requestTilesRun(self, request, tiles, tileSetID, callback, tileCallback):
+        requestID = request.requestID
+        if tileCallback:
+            onTile = lambda tile: tileCallback(requestID, tileSetID, tile)
+        else:
+            onTile = None
+        try:
+            self.provideTiles(tiles, tileCallback=onTile, request=request)
+        finally:
+            self.requests.pop(requestID, None)
+            callback(requestID, tileSetID)
+            
+    def _startRequest(self, request, tiles, tileSetID, callback, tileCallback):
+        if self.fetcher:
+            self.fetcher.submitRequest(self, request, tiles, tileSetID, callback, tileCallback)
+            return
+        thread = Thread(target=self._requestTilesRun, args=(request, tiles, tileSetID, callback, tileCallback))
+        thread.daemon = True
+        thread.start()
+            
+    def cancelRequest(self, requestID):
+        """ drops the tiles of the request not yet fetched, callback is still executed """
+        request = self.requests.get(requestID)
+        if request:
+            request.cancel()
+            
+    def cancelRequests(self):
+        for requestID in list(self.requests):
+            self.cancelRequest(requestID)
+    
+    def requestTileSet(self, lon, lat, zoom, w1, w2, h1, h2, callback, tileCallback=None):
+        """ plans the tile set immediately and provides its tiles in a background thread,
+            returns (requestID, tileSetID), see requestTiles()
+        """
+        requestID = self.createRequestID()
+        request = TileRequest(requestID)
+        self.requests[requestID] = request
+        tileset = self.planTiles(lon, lat, zoom, w1, w2, h1, h2)
+        tileSetID = self.addTileSet(tileset, pin=True)
+        tiles = list(self.iterTiles(tileset))
+        self._startRequest(request, tiles, tileSetID, callback, tileCallback)
+        return (requestID, tileSetID)
+    
+    def requestTileList(self, tiles, tileSetID, callback, tileCallback=None):
+        """ provides additional tiles of a tile set (see planTileRange) in a background thread,
+            returns requestID, the callbacks are executed as in requestTiles(),
+            the tile set is not pinned
+        """
+        requestID = self.createRequestID()
+        request = TileRequest(requestID)
+        self.requests[requestID] = request
+        self._startRequest(request, tiles, tileSetID, callback, tileCallback)
+        return requestID
+    
+    def requestTiles(self, lon, lat, zoom, w1, w2, h1, h2, callback, tileCallback=None):
         """ loads tiles in background thread 
+            tileCallback is executed with args requestID, tileSetID, tile for every tile 
+            as soon as it is available (cached tiles first)
             when finished callback is executed with args requestID, tileSetID 
+            the tile set is pinned, the receiver has to call unpinTileSet(tileSetID) after callback
+            the request can be cancelled with cancelRequest(requestID)
         """
-        requestID = self.createRequestID()
-        args = (lon, lat, zoom, w1, w2, h1, h2)
-        thread = Thread(target=self._requestTilesRun, args=(requestID, args, callback))
-        thread.daemon = True
-        thread.start()
+        (requestID, tileSetID) = self.requestTileSet(lon, lat, zoom, w1, w2, h1, h2, callback, tileCallback)
         return requestID
     
     def loadTiles(self, lon, lat, zoom, w1, w2, h1, h2):
         """ loads tiles immediately """
-        print("loadTiles(lon=%r, lat=%r, zoom=%r, w1=%r, w2=%r, h1=%r, h2=%r)" % (lon, lat, zoom, w1, w2, h1, h2))
+        log.debug("loadTiles(lon=%r, lat=%r, zoom=%r, w1=%r, w2=%r, h1=%r, h2=%r)", lon, lat, zoom, w1, w2, h1, h2)
         tileSet = self._loadTiles(lon, lat, zoom, w1, w2, h1, h2)
-        tileSetID = self.addTileSet(tileSet)
+        tileSetID = self.addTileSet(tileSet, pin=True)
         self.setActiveTileSet(tileSetID)
+        self.unpinTileSet(tileSetID)
+        
+    def getProjection(self, zoom) -> Projection:
+        """ projection of the scene of the active tile set """
+        upperLeftTile = self.getActiveTileSet().upperLeftTile
+        origin = (upperLeftTile.xtile, upperLeftTile.ytile)
+        return get_projection(zoom, origin=origin, tile_size=(self.tileWidth, self.tileHeight))
         
     def pixelToCoord(self, pixel_x, pixel_y, zoom):
-        tileSet = self.getActiveTileSet() 
-        xtilef = tileSet.upperLeftTile.xtile + pixel_x / self.tileWidth  
-        ytilef = tileSet.upperLeftTile.ytile + pixel_y / self.tileHeight
-        (lat, lon) = smopy.num2deg(xtilef, ytilef, zoom)
-        return (lon, lat)
+        """ scene pixel -> (lon, lat), also accepts numpy arrays """
+        return self.getProjection(zoom).fromPixel(pixel_x, pixel_y)
     
     def coordToPixel(self, lon, lat, zoom):
-        tileSet = self.getActiveTileSet()
-        (xtilef, ytilef) = smopy.deg2num(latitude=lat, longitude=lon, zoom=zoom, do_round=False)
-        x = (xtilef - tileSet.upperLeftTile.xtile) * self.tileWidth
-        y = (ytilef - tileSet.upperLeftTile.ytile) * self.tileHeight
-        return (x, y)
+        """ (lon, lat) -> scene pixel, also accepts numpy arrays """
+        return self.getProjection(zoom).toPixel(lon, lat)
         
     
     
+
+class TilePrefetcher():
+    """ warms the cache of a tile source at low priority with the tiles
+        ahead of the pan direction (lookahead seconds at the current pan velocity)
+        and the tiles of zoom +1 and -1 around the center, at most max_tiles per prefetch
+        planning and the cache lookup run as a job of the downloader at prefetch priority,
+        tileCallback(tile) is executed in download threads for every prefetched tile
+    """
+    
+    def __init__(self, tilesource:TileSource, max_tiles=48, lookahead=1.0, max_zoom=19, tileCallback=None):
+        self.tilesource = tilesource
+        self.maxTiles = max_tiles
+        self.maxZoom = max_zoom
+        self.lookahead = lookahead
+        self.tileCallback = tileCallback
+        self.velocity = (0.0, 0.0)      # pixel/s
+        self.lastPan = None
+        self.request = None
+        
+    def addPan(self, dx, dy):
+        """ updates the pan velocity with a move of (dx, dy) pixels """
+        current_time = now()
+        if self.lastPan is None or (current_time - self.lastPan) > 0.5:
+            self.velocity = (0.0, 0.0)
+        else:
+            dt = max(current_time - self.lastPan, 0.01)
+            # exponential smoothing
+            self.velocity = (0.7*self.velocity[0] + 0.3*dx/dt, 0.7*self.velocity[1] + 0.3*dy/dt)
+        self.lastPan = current_time
+        
+    def stopPan(self):
+        self.velocity = (0.0, 0.0)
+        self.lastPan = None
+        
+    def planTiles(self, lon, lat, zoom, vw, vh, velocity=None) -> list:
+        """ returns [(tilex, tiley, zoom), ...] in order of relevance, without the visible tiles 
+            velocity: pan velocity (pixel/s), defaults to the current one
+        """
+        tw, th = self.tilesource.tileWidth, self.tilesource.tileHeight
+        (cx, cy) = get_projection(zoom).toTile(lon, lat)
+        hw, hh = vw/2/tw, vh/2/th
+        visible = self.tileRange(cx-hw, cy-hh, cx+hw, cy+hh, zoom)
+        keys = []
+        # ahead of the pan direction
+        (vx, vy) = velocity or self.velocity
+        if vx or vy:
+            ax, ay = cx + vx*self.lookahead/tw, cy + vy*self.lookahead/th
+            ahead = self.tileRange(ax-hw, ay-hh, ax+hw, ay+hh, zoom)
+            ahead = [key for key in ahead if not(key in visible)]
+            ahead.sort(key=lambda k: (k[0]+0.5-ax)**2 + (k[1]+0.5-ay)**2)
+            keys.extend(ahead)
+        # zoom in: the central half of the view, zoom out: twice the view
+        for (dz, f) in ((1, 2.0), (-1, 0.5)):
+            z = zoom + dz
+            if z < 0 or z > self.maxZoom:
+                continue
+            zx, zy = cx*f, cy*f
+            keys.extend(self.tileRange(zx-hw, zy-hh, zx+hw, zy+hh, z))
+        return keys
+    
+    @staticmethod
+    def tileRange(x1, y1, x2, y2, zoom) -> list:
+        n = 2**zoom
+        xs = range(max(int(np.floor(x1)), 0), min(int(np.floor(x2)), n-1)+1)
+        ys = range(max(int(np.floor(y1)), 0), min(int(np.floor(y2)), n-1)+1)
+        return [(x, y, zoom) for x in xs for y in ys]
+        
+    def prefetch(self, lon, lat, zoom, vw, vh):
+        """ cancels the previous prefetch and starts a new one around (lon, lat), does not block """
+        self.cancel()
+        request = TileRequest(requestID=None)
+        self.request = request
+        args = (lon, lat, zoom, vw, vh, self.velocity, request)
+        self.tilesource.downloader.submitTile(("prefetch", id(request)), self._prefetchRun, args, request,
+                                              priority=PRIORITY_PREFETCH)
+        
+    def _prefetchRun(self, lon, lat, zoom, vw, vh, velocity, request):
+        keys = self.planTiles(lon, lat, zoom, vw, vh, velocity)[:self.maxTiles]
+        layer = self.tilesource.getLayerName()
+        cached = self.tilesource.cache.lookup(layer, keys)
+        for key in keys:
+            if request.cancelled:
+                break
+            if key in cached:
+                if self.tileCallback:
+                    self.tileCallback(self.createTile(*key, path=self.tilesource.cache.location(layer, *key)))
+                continue
+            future = self.tilesource.submitDownload(*key, request=request, priority=PRIORITY_PREFETCH)
+            if self.tileCallback:
+                future.add_done_callback(lambda f, key=key: self.onDownload(f, key, request))
+        
+    def onDownload(self, future, key, request):
+        if request.cancelled or future.exception() or future.result() is None:
+            return
+        self.tileCallback(self.createTile(*key, path=future.result()))
+            
+    @staticmethod
+    def createTile(tilex, tiley, zoom, path) -> Tile:
+        tile = Tile()
+        tile.path = path
+        tile.xtile = tilex
+        tile.ytile = tiley
+        tile.zoom = zoom
+        return tile
+        
+    def cancel(self):
+        if self.request:
+            self.request.cancel()
+            self.request = None
+    
         
 class OSMTileSourceA(TileSource):
     SRC_NAME = "osm-a"
+    LAYER = "osm"
     TILE_URL = "http://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
     
 class OSMTileSourceB(TileSource):
     SRC_NAME = "osm-b"
+    LAYER = "osm"
     TILE_URL = "http://b.tile.openstreetmap.org/{z}/{x}/{y}.png"
         
 class OSMTileSourceC(TileSource):
     SRC_NAME = "osm-c"
+    LAYER = "osm"
     TILE_URL = "http://C.tile.openstreetmap.org/{z}/{x}/{y}.png"
         
 class StamenTonerTileSource(TileSource):
@@ -282,31 +1012,32 @@ class OSMTileSource(TileSource):
     TILE_URL    = "http://{subdomain}.tile.openstreetmap.org/{z}/{x}/{y}.png"
     SUBDOMAINS  = ["a","b","c"]
     
-    def __init__(self, name, cachedir, download_delay=0.33):
-        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=download_delay)
-        self.subdomainIndex = 0
+    def __init__(self, name, cachedir, download_delay=1, **kwargs):
+        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=download_delay, **kwargs)
     
     def getTileUrl(self, tilex, tiley, zoom):
-        self.subdomainIndex += 1
-        if self.subdomainIndex >= len(self.SUBDOMAINS):
-            self.subdomainIndex = 0
-        subdomain = self.SUBDOMAINS[self.subdomainIndex]
+        # the same subdomain for a tile, its download is scheduled for the limiter of that host
+        subdomain = self.SUBDOMAINS[(tilex + tiley) % len(self.SUBDOMAINS)]
         return self.TILE_URL.format(subdomain=subdomain, x=tilex, y=tiley, z=zoom)
         
         
 class GoogleMapsSource(TileSource):
     SRC_NAME = "google-{maptype}"
-    TILE_URL = "https://maps.googleapis.com/maps/api/staticmap?center={lat},{lon}&zoom={zoom}&maptype={maptype}&size=256x256&key={key}"
+    TILE_URL = "https://maps.googleapis.com/maps/api/staticmap?center={lat},{lon}&zoom={zoom}&maptype={maptype}&size=256x256&scale={scale}&key={key}"
     
-    def __init__(self, name, cachedir, maptype, api_key, download_delay=1):
-        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=download_delay)
+    def __init__(self, name, cachedir, maptype, api_key, download_delay=1, **kwargs):
+        """ tile_size 256 or 512, the static map of a tile always covers 256x256 map pixels, 
+            512px images are requested with scale=2
+        """
+        TileSource.__init__(self, name=name, cachedir=cachedir, download_delay=download_delay, **kwargs)
         self.maptype = maptype
         self.api_key = api_key
         self.src_name_args = dict(maptype=maptype)
         
     def getTileUrl(self, tilex, tiley, zoom):
-        lat, lon = smopy.num2deg(tilex+0.5, tiley+0.5, zoom)
-        return self.TILE_URL.format(lon=lon, lat=lat, zoom=zoom, maptype=self.maptype, key=self.api_key)
+        lon, lat = tile_to_lonlat(tilex+0.5, tiley+0.5, zoom)
+        return self.TILE_URL.format(lon=lon, lat=lat, zoom=zoom, maptype=self.maptype, key=self.api_key,
+                                    scale=self.tileSize // 256)
         
         
 